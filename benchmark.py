@@ -0,0 +1,227 @@
+import subprocess, sys, os, tempfile, time, json, shlex, random, string, itertools
+from optparse import OptionParser
+from run_tests import start_server, OKBLUE, OKGREEN, FAIL, HEADER, ENDC
+from server import FileContent, CONTENT_FILENAME
+
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+
+default_lines = "1000,10000"
+default_loss_rates = "0,0.01"
+default_buffer_sizes = "5,20"  # 0 is an unbounded queue: behind a bandwidth limit it grows as long as the server
+# sends faster, without an ECN mark to slow it down
+default_clients = "1,4"
+default_propagation_delay = 0.005
+default_bandwidth = 100000  # below what one client gets unlimited, so a queue builds up for the buffer sizes to bound
+default_baseline = "benchmark-baseline.json"
+default_output = "benchmark-results.json"
+default_tolerance = 0.2
+
+default_max_line_length = 200  # well within a datagram with the id, sequence number and checksum
+LINE_ALPHABET_SIZE = 4096
+WRITE_CHUNK_LINES = 65536
+
+# metric -> whether higher is better
+COMPARED_METRICS = {
+	'goodput': True,
+	'completion_time': False,
+	'rtts': False,
+	'retransmission_ratio': False,
+	'server_cpu_seconds': False,
+	'server_peak_rss_kb': False,
+}
+# differences this small are noise whatever the relative change
+ABSOLUTE_SLACK = {
+	'completion_time': 0.05,
+	'rtts': 2,
+	'retransmission_ratio': 0.01,
+	'server_cpu_seconds': 0.05,
+}
+
+
+def generate_file(filename, lines, seed=0, max_line_length=default_max_line_length):
+	"""Write `lines` lines of random text, between 0 and `max_line_length` characters long."""
+	rng = random.Random(seed)
+	# slicing one random string is much faster than drawing every character
+	alphabet = ''.join(rng.choice(string.ascii_letters + string.digits + ' ') for _ in range(LINE_ALPHABET_SIZE)).encode()
+	with open(filename, 'wb') as f:
+		chunk = []
+		for _ in range(lines):
+			start = rng.randrange(LINE_ALPHABET_SIZE - max_line_length)
+			chunk.append(alphabet[start:start + rng.randint(0, max_line_length)])
+			if len(chunk) == WRITE_CHUNK_LINES:
+				f.write(b'\n'.join(chunk) + b'\n')
+				chunk = []
+		if chunk:
+			f.write(b'\n'.join(chunk) + b'\n')
+	# build the line index now, so that the servers' CPU time only covers transfers
+	FileContent(filename)
+
+
+def run_scenario(work_dir, lines, loss_rate, buffer_size, clients, options):
+	"""Download the server_file.txt of `work_dir` with `clients` clients at the same time over the link emulator."""
+	server_log = open(os.path.join(work_dir, 'server.log'), 'w')
+	server, port = start_server(shlex.split(options.server_args), server_log, cwd=work_dir)
+	try:
+		processes = []
+		for i in range(clients):
+			stats_file = os.path.join(work_dir, f'stats_{i}.json')
+			command = [sys.executable, CLIENT_SCRIPT, '-p', '0', '-s', f'127.0.0.1:{port}',
+			           '-o', os.path.join(work_dir, f'client_file_{i}.txt'), '--stats-file', stats_file, '--quiet',
+			           '--emulator=link', f'--propagation-delay={options.propagation_delay}',
+			           f'--bandwidth={options.bandwidth}', f'--loss-rate={loss_rate}', f'--seed={options.seed + i}']
+			if buffer_size > 0:
+				command.append(f'--set-server-buffer-size={buffer_size}')
+			command += shlex.split(options.client_args)
+			processes.append((stats_file, subprocess.Popen(command, stdout=subprocess.DEVNULL,
+			                                               stderr=subprocess.PIPE, text=True, cwd=work_dir)))
+		stats = []
+		for stats_file, process in processes:
+			errors = process.communicate()[1]
+			if process.returncode != 0:
+				raise RuntimeError(f"client failed:\n{errors}")
+			with open(stats_file) as f:
+				stats.append(json.load(f))
+	finally:
+		server.kill()
+		# reap the server ourselves, to get its resource usage
+		usage = os.wait4(server.pid, 0)[2]
+		server_log.close()
+
+	size = os.path.getsize(os.path.join(work_dir, CONTENT_FILENAME))
+	completion_time = max(client_stats['time'] for client_stats in stats)
+	server_packets = sum(client_stats['server_packets'] for client_stats in stats)
+	needed_packets = clients * (lines + 2)  # every line once, the FIN and the final ACK
+	return {
+		'lines': lines,
+		'loss_rate': loss_rate,
+		'buffer_size': buffer_size,
+		'clients': clients,
+		'bytes': size * clients,
+		'completion_time': completion_time,
+		'goodput': size * clients / completion_time,  # bytes per second
+		'rtts': max(client_stats['rounds'] for client_stats in stats),
+		'retransmission_ratio': max(0, server_packets - needed_packets) / server_packets,
+		'server_cpu_seconds': usage.ru_utime + usage.ru_stime,
+		'server_peak_rss_kb': usage.ru_maxrss,
+		'different_lines': sum(client_stats['different_lines'] for client_stats in stats),
+	}
+
+
+def scenario_key(result):
+	return (result['lines'], result['loss_rate'], result['buffer_size'], result['clients'])
+
+
+def find_regressions(results, baseline, tolerance):
+	"""(scenario, metric, baseline value, value) for every metric worse than the baseline by more than `tolerance`."""
+	baseline_results = {scenario_key(result): result for result in baseline['results']}
+	regressions = []
+	for result in results:
+		base = baseline_results.get(scenario_key(result))
+		if base is None:
+			continue
+		for metric, higher_is_better in COMPARED_METRICS.items():
+			slack = ABSOLUTE_SLACK.get(metric, 0)
+			if higher_is_better:
+				worse = result[metric] < base[metric] * (1 - tolerance) - slack
+			else:
+				worse = result[metric] > base[metric] * (1 + tolerance) + slack
+			if worse:
+				regressions.append((scenario_key(result), metric, base[metric], result[metric]))
+	return regressions
+
+
+def parse_list(value, kind):
+	return [kind(item) for item in value.split(',')]
+
+
+def run_benchmarks(options):
+	results = []
+	files_dir = tempfile.mkdtemp()
+	for lines in parse_list(options.lines, int):
+		# one generated file per size, shared by the scenarios through hard links
+		filename = os.path.join(files_dir, f'{lines}.txt')
+		print(f"{HEADER}Generating {lines} lines{ENDC}")
+		generate_file(filename, lines, options.seed, options.max_line_length)
+		for loss_rate, buffer_size, clients in itertools.product(parse_list(options.loss_rates, float),
+		                                                         parse_list(options.buffer_sizes, int),
+		                                                         parse_list(options.clients, int)):
+			with tempfile.TemporaryDirectory() as work_dir:
+				for suffix in ('', '.idx'):
+					os.link(filename + suffix, os.path.join(work_dir, CONTENT_FILENAME + suffix))
+				result = run_scenario(work_dir, lines, loss_rate, buffer_size, clients, options)
+			results.append(result)
+			status = f"{OKGREEN}OK{ENDC}" if result['different_lines'] == 0 else f"{FAIL}CORRUPTED{ENDC}"
+			print(f"# lines={lines} loss={loss_rate} buffer={buffer_size or 'unbounded'} clients={clients} --> {status} "
+			      f"goodput: {OKBLUE}{result['goodput'] / 1000:.1f} KB/s{ENDC}, "
+			      f"time: {result['completion_time']:.2f} s, RTTs: {result['rtts']}, "
+			      f"retransmissions: {result['retransmission_ratio']:.1%}, "
+			      f"server CPU: {result['server_cpu_seconds']:.2f} s, RSS: {result['server_peak_rss_kb'] / 1024:.1f} MB")
+		for suffix in ('', '.idx'):
+			os.remove(filename + suffix)
+	os.rmdir(files_dir)
+	return results
+
+
+if __name__ == "__main__":
+	parser = OptionParser()
+	parser.add_option("--lines", dest="lines", type="string", default=default_lines,
+	                  help="sizes of the generated files, in lines (default: {})".format(default_lines))
+	parser.add_option("--loss-rates", dest="loss_rates", type="string", default=default_loss_rates,
+	                  help="random loss rates of the link in each direction (default: {})".format(default_loss_rates))
+	parser.add_option("--buffer-sizes", dest="buffer_sizes", type="string", default=default_buffer_sizes,
+	                  help="sizes of the queue towards the client, 0 for unbounded (default: {})".format(
+		                  default_buffer_sizes))
+	parser.add_option("--clients", dest="clients", type="string", default=default_clients,
+	                  help="numbers of clients downloading at the same time (default: {})".format(default_clients))
+	parser.add_option("--propagation-delay", dest="propagation_delay", type="float", default=default_propagation_delay,
+	                  help="one-way delay of the link in seconds (default: {})".format(default_propagation_delay))
+	parser.add_option("--bandwidth", dest="bandwidth", type="float", default=default_bandwidth, metavar="BYTES_PER_S",
+	                  help="bandwidth of the link, 0 for unlimited, which needs --buffer-sizes 0 (default: {})".format(
+		                  default_bandwidth))
+	parser.add_option("--max-line-length", dest="max_line_length", type="int", default=default_max_line_length,
+	                  help="lines of the generated files are 0 to this many characters long (default: {})".format(
+		                  default_max_line_length))
+	parser.add_option("--server-args", dest="server_args", type="string", default="",
+	                  help="options for the server, e.g. \"--congestion-control=cubic\"")
+	parser.add_option("--client-args", dest="client_args", type="string", default="",
+	                  help="more options for the clients, e.g. \"--sack --multi-line-segments\"")
+	parser.add_option("--seed", dest="seed", type="int", default=0,
+	                  help="seed of the generated files and of the losses (default: 0)")
+	parser.add_option("--output", dest="output", type="string", default=default_output,
+	                  help="where to write the results as JSON (default: {})".format(default_output))
+	parser.add_option("--baseline", dest="baseline", type="string", default=default_baseline,
+	                  help="results to compare with, skipped if the file does not exist (default: {})".format(
+		                  default_baseline))
+	parser.add_option("--tolerance", dest="tolerance", type="float", default=default_tolerance,
+	                  help="relative change of a metric that counts as a regression (default: {})".format(
+		                  default_tolerance))
+	(options, args) = parser.parse_args()
+	if not options.bandwidth and any(parse_list(options.buffer_sizes, int)):
+		parser.error("an unlimited --bandwidth never queues a packet, use --buffer-sizes 0 with it")
+
+	start = time.time()
+	results = run_benchmarks(options)
+	settings = {name: getattr(options, name) for name in
+	            ('propagation_delay', 'bandwidth', 'server_args', 'client_args', 'seed')}
+	if options.max_line_length != default_max_line_length:  # so that the stored baseline still matches by default
+		settings['max_line_length'] = options.max_line_length
+	with open(options.output, 'w') as f:
+		json.dump({'settings': settings, 'results': results}, f, indent=1)
+	print(f"# Total time: {OKBLUE}{time.time() - start:.2f} seconds{ENDC}, results written to {options.output}")
+
+	failed = sum(result['different_lines'] > 0 for result in results)
+	if failed > 0:
+		print(f"{FAIL}{failed} scenarios did not transfer the file correctly{ENDC}")
+	if os.path.exists(options.baseline):
+		with open(options.baseline) as f:
+			baseline = json.load(f)
+		if baseline['settings'] != settings:
+			print(f"{FAIL}The baseline was measured with different settings: {baseline['settings']}{ENDC}")
+		regressions = find_regressions(results, baseline, options.tolerance)
+		for (key, metric, base, value) in regressions:
+			print(f"{FAIL}REGRESSION{ENDC} lines={key[0]} loss={key[1]} buffer={key[2]} clients={key[3]}: "
+			      f"{metric} {base:.4g} -> {value:.4g}")
+		if not regressions:
+			print(f"{OKGREEN}No regressions against {options.baseline}{ENDC}")
+		failed += len(regressions)
+	sys.exit(1 if failed > 0 else 0)
@@ -1,7 +1,9 @@
 #! /usr/bin/python3
 
-import sys, socket, subprocess, hashlib, re, time
+import sys, os, io, zlib, socket, subprocess, re, time, heapq, itertools, select, random, collections, json
 from optparse import OptionParser, OptionValueError
+from tracing import Tracer, NULL_TRACER
+from integrity import INTEGRITY_CHECKS, DEFAULT_INTEGRITY, check_integrity
 import threading
 
 # default parameters
@@ -10,9 +12,17 @@ default_port = 40023
 default_server_string = "127.0.0.1:50023"
 default_outfile_string = "client_file.txt"
 default_queuing_delay = 0.1
+default_fsync_policy = "end"
+default_streams = 1
+default_chunk_lines = 10000
 
 # constants
 ECN_preamble="ECN dropped"
+ECN_preamble_bytes=ECN_preamble.encode()
+min_round_time = 0.001  # rounds of the link emulation when there is no propagation delay
+max_sack_blocks = 8
+output_buffer_size = 1 << 16
+additional_packets_timeout = 2  # how long to listen for server packets after the transfer
 
 ######################
 # Network processing #
@@ -22,6 +32,9 @@ class PacketProcessor:
   def __init__(self):
     self.client_packets = 0
     self.dropclientpkts = []
+    # client packets that went out, the copies of a tripled ACK counting three times as in the queuing emulation
+    self.forwarded_client_packets = 0
+    self.dup_ack_drops = set()
     self.server_packets = 0
     self.dropserverpkts = []
 
@@ -33,6 +46,8 @@ class PacketProcessor:
 
   def change_ack_number(self,data,value_change):
     m = re.match(".*ACK (\d+).*",data.decode())
+    if m is None:    # e.g. ACK FIN, no number to change
+      return data
     ackno = m.group(1)
     return data.decode().replace("ACK {}".format(ackno),"ACK {}".format(int(ackno)+value_change),1).encode()
 
@@ -42,16 +57,57 @@ class PacketProcessor:
       return None
     return data
 
+  def forward_client_packet(self,data,acks2triple):
+    # how many copies of a client packet go out: none if it is dropped, three for the ACKs to triple
+    if self.process_client_packet(data) is None:
+      return 0
+    copies = 3 if str(self.forwarded_client_packets + 1) in acks2triple and b"ACK" in data else 1
+    self.forwarded_client_packets += copies
+    return copies
+
+  def drop_for_dup_ack(self,acks2triple,pending):
+    # whether to drop a server packet so that the client packet answering it, the ACK to triple, is a duplicate;
+    # `pending` server packets reach the client before it. Each ACK to triple drops one server packet.
+    number = str(self.forwarded_client_packets + 1 + pending)
+    if number not in acks2triple or number in self.dup_ack_drops:
+      return False
+    self.dup_ack_drops.add(number)
+    return True
+
   def process_server_packet(self,data):
-    client_address_list = data.decode().split("]")[0].lstrip("[").split(":")
-    client_address = (client_address_list[0],int(client_address_list[1]))
-    payload = data.decode().split("]")[1]
+    client_address_list = data[data.find(b"[") + 1:data.find(b"]")].split(b":")
+    client_address = (client_address_list[0].decode(),int(client_address_list[1]))
     new_data = data
     self.server_packets += 1
     if str(self.server_packets) in self.dropserverpkts:
       new_data = None
     return (client_address,new_data)
 
+class SharedPacketProcessor(PacketProcessor):
+  """A PacketProcessor the streams of a parallel download use at once, from their own threads.
+
+  The packets to drop or to triple are counted over the whole download.
+  """
+  def __init__(self):
+    super().__init__()
+    self.lock = threading.RLock()
+
+  def process_client_packet(self,data):
+    with self.lock:
+      return super().process_client_packet(data)
+
+  def forward_client_packet(self,data,acks2triple):
+    with self.lock:
+      return super().forward_client_packet(data,acks2triple)
+
+  def drop_for_dup_ack(self,acks2triple,pending):
+    with self.lock:
+      return super().drop_for_dup_ack(acks2triple,pending)
+
+  def process_server_packet(self,data):
+    with self.lock:
+      return super().process_server_packet(data)
+
 #####################
 # Network buffering #
 #####################
@@ -72,15 +128,15 @@ class PacketBuffer:
     self.available_space = self.size
 
   def enqueue(self, data, sender_address):
-    textdata = data.decode().strip()
+    data = data.strip()
     send_back = False
     # if sender_address == server_address:
       # print(f"trying to enqueue data {data}, available space {self.available_space}\n")
 
     if self.available_space <= 0:
-      textdata = "{} {}".format(ECN_preamble,textdata)
+      data = ECN_preamble_bytes + b" " + data
       send_back = True
-    self.queue.append((textdata.encode(),sender_address,send_back))
+    self.queue.append((data,sender_address,send_back))
     self.available_space -= 1
 
   def dequeue(self):
@@ -98,25 +154,459 @@ class PacketBuffer:
   def __repr__(self):
     return str(self)
 
+##################
+# Link emulation #
+##################
+
+class RandomLoss:
+  def __init__(self,rate,rng):
+    self.rate = rate
+    self.rng = rng
+
+  def lost(self):
+    return self.rng.random() < self.rate
+
+class GilbertElliottLoss:
+  """Two-state Markov loss model: losses come in bursts while the link is in the bad state."""
+  def __init__(self,good_to_bad,bad_to_good,loss_in_bad,rng):
+    self.good_to_bad = good_to_bad
+    self.bad_to_good = bad_to_good
+    self.loss_in_bad = loss_in_bad
+    self.rng = rng
+    self.bad = False
+
+  def lost(self):
+    if self.rng.random() < (self.bad_to_good if self.bad else self.good_to_bad):
+      self.bad = not self.bad
+    return self.bad and self.rng.random() < self.loss_in_bad
+
+class Link:
+  """One direction of an emulated link.
+
+  Packets wait in a FIFO queue of at most `capacity` packets that is drained at
+  `bandwidth` bytes per second (0 for no limit), then take `delay` seconds to
+  reach the other end. `loss`, if set, decides which packets are lost on the way.
+  Without a bandwidth limit the queue is always empty, so `capacity` only
+  matters with one.
+  """
+  def __init__(self,bandwidth,delay,capacity=sys.maxsize,loss=None):
+    self.bandwidth = bandwidth
+    self.delay = delay
+    self.capacity = capacity
+    self.loss = loss
+    self.departures = collections.deque()  # when each queued packet finishes transmission
+    self.busy_until = 0.0
+
+  def is_full(self,now):
+    while self.departures and self.departures[0] <= now:
+      self.departures.popleft()
+    return len(self.departures) >= self.capacity
+
+  def transmit(self,size,now):
+    # arrival time at the other end, None if the packet is lost
+    self.busy_until = max(now,self.busy_until) + (size / self.bandwidth if self.bandwidth else 0)
+    self.departures.append(self.busy_until)
+    if self.loss is not None and self.loss.lost():
+      return None
+    return self.busy_until + self.delay
+
+class SharedLink(Link):
+  """A Link the streams of a parallel download use at once, from their own threads.
+
+  A single transfer uses a plain Link, which does not pay for the lock on every packet.
+  """
+  def __init__(self,bandwidth,delay,capacity=sys.maxsize,loss=None):
+    super().__init__(bandwidth,delay,capacity,loss)
+    self.lock = threading.Lock()
+
+  def is_full(self,now):
+    with self.lock:
+      return super().is_full(now)
+
+  def transmit(self,size,now):
+    with self.lock:
+      return super().transmit(size,now)
+
+class ServerRounds:
+  """The rounds with server packets of the link emulation, which --set-server-buffer-size-changes refers to.
+
+  A round is one base RTT of the link, counted from the start of the transfer.
+  When a round with a buffer size change gets its first server packet, the
+  queue of `link`, towards the client, grows or shrinks by that many packets.
+  """
+  def __init__(self,link,server_buffer,server_buffer_changes,round_time):
+    self.link = link
+    self.link.capacity = server_buffer.get_size()
+    self.changes = server_buffer_changes
+    self.round_time = round_time
+    self.start_time = None
+    self.last_round = -1
+    self.count = 0
+
+  def start(self,now):
+    if self.start_time is None:
+      self.start_time = now
+
+  def server_packet(self,now):
+    server_round = int((now - self.start_time) / self.round_time)
+    if server_round == self.last_round:
+      return
+    self.last_round = server_round
+    self.count += 1
+    change = self.changes.pop(self.count,None)
+    if change is not None:
+      self.link.capacity = max(self.link.capacity + change,1)
+
+class SharedServerRounds(ServerRounds):
+  """ServerRounds of a parallel download: the rounds of all the streams count together, from the first
+  stream's start, under the lock of their SharedLink."""
+  def start(self,now):
+    with self.link.lock:
+      super().start(now)
+
+  def server_packet(self,now):
+    with self.link.lock:
+      super().server_packet(now)
+
+class LinkEmulator:
+  """Event-driven network between the client and the server.
+
+  Instead of releasing packets once per queuing cycle, every packet is scheduled
+  to arrive when the link would deliver it, and the emulator sleeps until the
+  next arrival or datagram. Packets stay bytes from end to end. A server packet
+  that finds the queue towards the client full is bounced back to the server
+  with the ECN preamble, like in the queuing cycle emulation. A round, used for
+  the RTT count and for --set-server-buffer-size-changes, is one base RTT of the
+  link; `server_rounds` counts the latter and may be shared with other emulators.
+  """
+  def __init__(self,sock,server_address,network_processing,acks2triple,server_rounds,to_server,to_client,
+               tracer=NULL_TRACER):
+    self.sock = sock
+    self.tracer = tracer
+    self.server_address = server_address
+    self.network_processing = network_processing
+    self.acks2triple = acks2triple
+    self.server_rounds = server_rounds
+    self.to_server = to_server
+    self.to_client = to_client
+    self.round_time = link_round_time(to_server,to_client)
+    self.events = []  # (time, order, destination, data), destination None for the client
+    self.order = itertools.count()
+    self.last_transmitted = None
+    self.start_time = None
+    self.finish_time = None
+    self.server_packets = 0
+    self.ecn_packets = 0
+    self.to_client_pending = 0  # server packets on their way to the client
+
+  def schedule(self,when,destination,data):
+    heapq.heappush(self.events,(when,next(self.order),destination,data))
+
+  def enqueue(self,data,sender_address):
+    # called by the client for every packet it sends to the server
+    now = time.time()
+    copies = self.network_processing.forward_client_packet(data,self.acks2triple)
+    if not copies:
+      self.tracer.packet("client_packet",data,fate="dropped")
+      return
+    self.last_transmitted = data
+    for _ in range(copies):
+      arrival = self.to_server.transmit(len(data),now)
+      self.tracer.packet("client_packet",data,fate="lost" if arrival is None else "forwarded")
+      if arrival is not None:
+        self.schedule(arrival,self.server_address,data)
+
+  def receive_from_server(self,data,now):
+    if not self.network_processing.process_server_packet(data)[1]:
+      self.tracer.packet("server_packet",data,fate="dropped")
+      return
+    self.server_packets += 1
+    if self.to_client.is_full(now):
+      self.ecn_packets += 1
+      self.tracer.packet("server_packet",data,fate="ecn")
+      self.schedule(now + self.to_server.delay,self.server_address,ECN_preamble_bytes + b" " + data)
+      return
+    if self.network_processing.drop_for_dup_ack(self.acks2triple,self.to_client_pending):
+      self.tracer.packet("server_packet",data,fate="dup_ack_drop")
+      return
+    arrival = self.to_client.transmit(len(data),now)
+    self.tracer.packet("server_packet",data,fate="lost" if arrival is None else "forwarded")
+    if arrival is not None:
+      self.to_client_pending += 1
+      self.schedule(arrival,None,data)
+
+  def rounds(self):
+    return int((self.finish_time - self.start_time) / self.round_time) + 1
+
+  def run(self,client,rtx_timeout,max_rtx):
+    # returns whether the transfer finished
+    self.sock.setblocking(False)
+    self.start_time = time.time()
+    self.server_rounds.start(self.start_time)
+    self.tracer.event("start",emulator="link",round_time=self.round_time)
+    self.last_transmitted = client.start_transfer(self)
+    next_rtx = self.start_time + rtx_timeout
+    rtx = 0
+    while True:
+      now = time.time()
+      deadline = min(self.events[0][0],next_rtx) if self.events else next_rtx
+      if deadline > now:
+        select.select([self.sock],[],[],deadline - now)
+      while True:
+        try:
+          (data,sender_address) = self.sock.recvfrom(512)
+        except BlockingIOError:
+          break
+        if sender_address == self.server_address:
+          self.receive_from_server(data,time.time())
+      now = time.time()
+      while self.events and self.events[0][0] <= now:
+        (_,_,destination,data) = heapq.heappop(self.events)
+        if destination is not None:
+          self.sock.sendto(data,destination)
+          continue
+        self.to_client_pending -= 1
+        self.server_rounds.server_packet(now)
+        rtx = 0
+        next_rtx = now + rtx_timeout
+        if client.process_server_packet(data,self):
+          self.finish_time = time.time()
+          self.tracer.event("finish",finished=True,rounds=self.rounds())
+          return True
+      if now >= next_rtx:
+        if rtx >= max_rtx:
+          self.finish_time = now
+          self.tracer.event("finish",finished=False,rounds=self.rounds())
+          return False
+        self.tracer.event("client_rtx")
+        self.enqueue(self.last_transmitted,None)
+        rtx += 1
+        next_rtx = now + rtx_timeout
+
+class RoundsEmulator:
+  """Queuing cycle emulation: packets are held for `queuing_delay` seconds and then
+  released together, and every cycle with traffic counts as one round."""
+  def __init__(self,sock,server_address,network_processing,acks2triple,client_buffer,server_buffer,
+               server_buffer_changes,queuing_delay,clock=time.time,verbose=True,tracer=NULL_TRACER):
+    self.sock = sock
+    self.tracer = tracer
+    self.server_address = server_address
+    self.network_processing = network_processing
+    self.acks2triple = acks2triple
+    self.client_buffer = client_buffer
+    self.server_buffer = server_buffer
+    self.server_buffer_changes = server_buffer_changes
+    self.queuing_delay = queuing_delay
+    self.clock = clock
+    self.verbose = verbose
+    self.server_packets = 0
+    self.ecn_packets = 0
+    self.total_rounds = 0
+
+  def log(self,message):
+    if self.verbose:
+      print(message)
+
+  def rounds(self):
+    return self.total_rounds
+
+  def run_queuing_cycle(self):
+    init_time = self.clock()
+    try:
+      elapsed_time = 0
+      while elapsed_time <= self.queuing_delay:
+        if self.queuing_delay > 0:
+          self.sock.settimeout(self.queuing_delay - elapsed_time)
+        (data, sender_address,) = self.sock.recvfrom(512)
+        if sender_address != self.server_address:    # data from client
+          self.client_buffer.enqueue(data, sender_address)
+        else:                                        # data from server
+          self.server_buffer.enqueue(data, sender_address)
+        elapsed_time = self.clock() - init_time
+    except socket.timeout:
+      pass
+
+  def run(self,client,rtx_timeout,max_rtx):
+    # returns whether the transfer finished
+    client_buffer = self.client_buffer
+    server_buffer = self.server_buffer
+    network_processing = self.network_processing
+    acks2triple = self.acks2triple
+    client_packet_no = 0
+    transmission_started = False
+    server_packet_rounds = 0
+    next_rtx = self.clock() + rtx_timeout
+    curr_rtx = 0
+    self.tracer.event("start",emulator="rounds",queuing_delay=self.queuing_delay)
+    last_transmitted = client.start_transfer(client_buffer)
+    while True:
+      self.run_queuing_cycle()
+      if transmission_started:
+        self.total_rounds += 1
+        self.tracer.event("round",round=self.total_rounds)
+      # deal with cases where there is no packet to send or receive, checking if the clients want to retransmit or to give up
+      if client_buffer.is_empty() and server_buffer.is_empty():
+        if curr_rtx >= max_rtx:
+          self.tracer.event("finish",finished=False,rounds=self.total_rounds)
+          return False
+        if self.clock() > next_rtx:
+          self.tracer.event("client_rtx")
+          client_buffer.enqueue(last_transmitted,(client.ownipaddr,client.ownport))
+          curr_rtx += 1
+        else:
+          continue
+      self.log("")
+      # process data from client
+      for (data,sender_address,send_back) in client_buffer.dequeue():
+        transmission_started = True
+        fwd_data = network_processing.process_client_packet(data)
+        destination = self.server_address
+        if send_back:
+          destination = sender_address
+        if fwd_data:
+          last_transmitted = fwd_data
+          next_rtx = self.clock() + rtx_timeout
+          if b"ACK" in fwd_data and str(client_packet_no+1) in acks2triple:
+            network_processing.change_ack_number(data,-1)
+            self.tracer.packet("client_packet",fwd_data,fate="tripled")
+            for i in range(3):
+              self.log("Forwarding {} from {} to {}".format(fwd_data,sender_address,destination))
+              self.sock.sendto(fwd_data,destination)
+              client_packet_no += 1
+            break
+          else:
+            self.log("Forwarding {} from {} to {}".format(fwd_data,sender_address,destination))
+            self.tracer.packet("client_packet",fwd_data,fate="forwarded")
+            self.sock.sendto(fwd_data,destination)
+            client_packet_no += 1
+        else:
+          self.log("Dropped client packet {}".format(data))
+          self.tracer.packet("client_packet",data,fate="dropped")
+
+      # process data from server
+      iteration_with_srv_packets = False
+      transfer_finished = False
+      curr_forwarded = 0
+      for (origin_data,sender_address,send_back) in server_buffer.dequeue():
+        (_,data) = network_processing.process_server_packet(origin_data)
+        if not data:
+          self.log("Dropped server packet {}".format(origin_data))
+          self.tracer.packet("server_packet",origin_data,fate="dropped")
+          continue
+        if send_back:
+          self.log("Forwarding back ECN packet {}".format(origin_data))
+          self.tracer.packet("server_packet",origin_data,fate="ecn")
+          self.sock.sendto(origin_data,self.server_address)
+          self.ecn_packets += 1
+        elif str(client_packet_no + 1 + curr_forwarded) in acks2triple:
+          self.log("Dropped server packet {}".format(data))
+          self.tracer.packet("server_packet",origin_data,fate="dup_ack_drop")
+          curr_forwarded += 1
+        else:
+          self.tracer.packet("server_packet",origin_data,fate="forwarded")
+          iteration_with_srv_packets = True
+          curr_rtx = 0
+          curr_forwarded += 1
+          transfer_finished = client.process_server_packet(data,client_buffer)
+        self.server_packets += 1
+      # adjust buffer size if needed
+      if iteration_with_srv_packets:
+        server_packet_rounds += 1
+      if server_packet_rounds in self.server_buffer_changes:
+        server_buffer.set_size(server_buffer.get_size() + self.server_buffer_changes[server_packet_rounds])
+        self.server_buffer_changes.pop(server_packet_rounds)  # we must remove buffer size change, otherwise we would keep decreasing the buffer size until we get another server packet
+      # handle terminated connections
+      if transfer_finished:
+        self.tracer.event("finish",finished=True,rounds=self.total_rounds)
+        return True
+
 ##########
 # Client #
 ##########
 
 class Client:
-  def __init__(self,own_ipaddr,own_port):
-    msg_preamble = "\[[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+:[0-9]+\]"
-    self.server_syntax = re.compile(r'({} )?{} (FIN|ACK|[a-zA-Z0-9]+:.*\|.*)$'.format(ECN_preamble,msg_preamble))
-    self.received = ""
+  def __init__(self,own_ipaddr,own_port,outfilename,multi_line_segments=False,sack=False,
+               fsync_policy=default_fsync_policy,verbose=True,tracer=NULL_TRACER,line_range=None,append=False,
+               integrity=DEFAULT_INTEGRITY,compress=False):
+    # compressed segments hold whole lines, like the multi-line ones a server without compression falls back to
+    self.multi_line_segments = multi_line_segments or compress
+    self.compress = compress
+    self.integrity = integrity  # the check asked for; packets are verified with whichever one they carry
+    self.line_range = line_range  # "START[-END]" to get only those lines, e.g. the rest of an interrupted download
+    # when resuming, the lines are appended to what the output file has, and kept if the transfer fails
+    self.append = append
+    self.tracer = tracer
+    self.verbose = verbose
+    self.sack = sack
+    self.fsync_policy = fsync_policy
+    # lines are appended as soon as they are acknowledged, only out-of-order packets stay in memory;
+    # an already open binary file (e.g. io.BytesIO in simulation.py) can be passed instead of a name
+    if hasattr(outfilename,"write"):
+      self.outfile = outfilename
+    else:
+      self.outfile = open(outfilename,"ab" if append else "wb",buffering=output_buffer_size)
+    self.out_of_order = {}
     self.ownipaddr = own_ipaddr
     self.ownport = own_port
-    self.own_id = "{}:{}".format(ownipaddr,ownport)
+    self.own_id = "{}:{}".format(own_ipaddr,own_port)
     self.last_acked = -1
   
   def set_failed_transfer(self):
-    self.received = ""
+    if not self.append:
+      self.outfile.seek(0)
+      self.outfile.truncate()
+    self.out_of_order = {}
 
   def get_open_message(self):
-    return "[{}] GET".format(self.own_id)
+    options = ""
+    if self.line_range is not None:
+      options += " " + self.line_range
+    if self.multi_line_segments:
+      options += " segments"
+    if self.compress:
+      options += " deflate"
+    if self.sack:
+      options += " sack"
+    if self.integrity != DEFAULT_INTEGRITY:
+      options += " " + self.integrity
+    return "[{}] GET{}".format(self.own_id,options)
+
+  def get_ack_message(self):
+    # cumulative ACK, plus the ranges received beyond it when using selective ACKs
+    tosend = "[{}] ACK {}".format(self.own_id,self.last_acked)
+    if self.out_of_order:
+      blocks = []
+      for seqno in sorted(self.out_of_order):
+        if blocks and blocks[-1][1] == seqno - 1:
+          blocks[-1][1] = seqno
+        else:
+          blocks.append([seqno,seqno])
+      tosend += " SACK " + ",".join("{}-{}".format(first,last) for (first,last) in blocks[:max_sack_blocks])
+    return tosend
+
+  def inflate(self,data,start,end):
+    try:
+      payload = zlib.decompress(memoryview(data)[start:end])
+    except zlib.error:  # not compressed, the server does not support it
+      return (data,start,end)
+    return (payload,0,len(payload))
+
+  def store_content(self,data,start,end):
+    # write data[start:end] straight from the datagram, returns the number of lines written
+    if self.compress:
+      (data,start,end) = self.inflate(data,start,end)
+    if not self.multi_line_segments:
+      newline = data.find(b"\n",start,end)
+      end = end if newline == -1 else newline
+      self.outfile.write(memoryview(data)[start:end])
+      self.outfile.write(b"\n")
+      return 1
+    self.outfile.write(memoryview(data)[start:end])
+    lines = data.count(b"\n",start,end)
+    if end > start and data[end - 1] == ord("\n"):
+      return lines
+    self.outfile.write(b"\n")
+    return lines + 1
 
   def start_transfer(self,client_buffer):
     packet = self.get_open_message().encode()
@@ -124,51 +614,259 @@ class Client:
     return packet
 
   def process_server_packet(self,data,client_buffer):
+    # data is "[ip:port] FIN", "[ip:port] ACK" or "[ip:port] <seqno>:<content>|<md5 of content>",
+    # parsed in place without decoding it
     transfer_finished = False
-    print("Received (in client) {}".format(data))
-    if not self.server_syntax.match(data.decode().strip().replace("\n","")):
+    if self.verbose:
+      print("Received (in client) {}".format(data))
+    start = len(ECN_preamble) + 1 if data.startswith(ECN_preamble_bytes) else 0
+    id_end = data.find(b"] ",start)
+    colon = data.find(b":",id_end + 2)
+    checksum_start = data.rfind(b"|") + 1
+    msg = memoryview(data)[id_end + 2:]
+    if data[start:start + 1] != b"[" or id_end == -1 or \
+       (msg != b"FIN" and msg != b"ACK" and (colon == -1 or checksum_start <= colon)):
       print("Discarded packet {} because it does not have a valid syntax".format(data))
+      return transfer_finished
+    if msg == b"ACK":
+      return True
+    if msg == b"FIN":
+      tosend = "[{}] ACK FIN".format(self.own_id)
     else:
-      conndata = data.decode().split("]")[0]  
-      msg = data.decode().split("]")[1]
-      metadata = msg.split(":")[0].strip()
-      tosend = "[{}] ACK {}".format(self.own_id,metadata)
-      if msg.strip() == "ACK":
-        transfer_finished = True
-      elif msg.strip() != "FIN":
-        try:
-          seqno = int(metadata)
-        except ValueError as e:
-          print("Discarded packet {} because sequence number {} is not an integer".format(msg,metadata))
-          return transfer_finished
-        payload = ":".join(msg.split(":")[1:])
-        (content,checksum) = payload.split("|")
-        if seqno != self.last_acked + 1 or not check_integrity(content,checksum):
-          tosend = "[{}] ACK {}".format(self.own_id,self.last_acked)
-        else:
-          self.received += content.split("\n")[0] + "\n"
-          self.last_acked = seqno
-      if not transfer_finished:
-        client_buffer.enqueue(tosend.encode(),(self.ownipaddr,self.ownport))
+      try:
+        seqno = int(data[id_end + 2:colon])
+      except ValueError as e:
+        print("Discarded packet {} because sequence number {} is not an integer".format(msg.tobytes(),data[id_end + 2:colon]))
+        return transfer_finished
+      valid = check_integrity(memoryview(data)[colon + 1:checksum_start - 1],memoryview(data)[checksum_start:])
+      if seqno != self.last_acked + 1 or not valid:
+        if self.sack and seqno > self.last_acked + 1 and valid:
+          self.out_of_order[seqno] = (data,colon + 1,checksum_start - 1)
+      else:
+        lines = self.store_content(data,colon + 1,checksum_start - 1)
+        self.last_acked = seqno
+        self.tracer.event("deliver",seq=seqno,lines=lines)
+        while self.last_acked + 1 in self.out_of_order:
+          self.last_acked += 1
+          lines = self.store_content(*self.out_of_order.pop(self.last_acked))
+          self.tracer.event("deliver",seq=self.last_acked,lines=lines)
+        if self.fsync_policy == "always":
+          self.sync_output()
+      tosend = self.get_ack_message()
+    client_buffer.enqueue(tosend.encode(),(self.ownipaddr,self.ownport))
     return transfer_finished
 
-  def write_file(self,outfilename):
-    with open(outfilename,"w") as f:
-      f.write(self.received)
+  def sync_output(self):
+    self.outfile.flush()
+    os.fsync(self.outfile.fileno())
+
+  def close_output(self):
+    if self.fsync_policy != "never":
+      self.sync_output()
+    self.outfile.close()
+
+#####################
+# Parallel download #
+#####################
+
+class ChunkSchedule:
+  """Hands out the line ranges of a parallel download, and writes the chunks to the output file in order.
+
+  Chunks are `chunk_lines` lines from `first_line` on, up to `last_line` if
+  given. The number of lines in the file is not known up front: a chunk that
+  comes back with fewer lines than asked for is the last one. Streams do not
+  run more than `max_ahead` chunks ahead of the output file, so the chunks
+  waiting for an earlier one stay few.
+  """
+  def __init__(self,outfile,chunk_lines,first_line=0,last_line=None,max_ahead=2):
+    self.outfile = outfile
+    self.chunk_lines = chunk_lines
+    self.first_line = first_line
+    self.last_line = last_line
+    self.max_ahead = max_ahead
+    self.condition = threading.Condition()
+    self.next_chunk = 0
+    self.written = 0  # chunks already in the output file
+    self.received = {}  # chunk -> lines, waiting for the chunks before them
+    self.last_chunk = None
+    self.failed = False
+
+  def bounds(self,chunk):
+    start = self.first_line + chunk * self.chunk_lines
+    end = start + self.chunk_lines - 1
+    return (start,end if self.last_line is None else min(end,self.last_line))
+
+  def claim(self):
+    # the next chunk to download, None once there is nothing left
+    with self.condition:
+      while not self.failed and self.last_chunk is None and self.next_chunk - self.written >= self.max_ahead:
+        self.condition.wait()
+      (start,end) = self.bounds(self.next_chunk)
+      if self.failed or (self.last_chunk is not None and self.next_chunk > self.last_chunk) or start > end:
+        return None
+      self.next_chunk += 1
+      return self.next_chunk - 1
+
+  def deliver(self,chunk,data):
+    with self.condition:
+      (start,end) = self.bounds(chunk)
+      if data.count(b"\n") < end - start + 1 and (self.last_chunk is None or chunk < self.last_chunk):
+        self.last_chunk = chunk
+      self.received[chunk] = data
+      while self.written in self.received:
+        self.outfile.write(self.received.pop(self.written))
+        self.written += 1
+      self.condition.notify_all()
+
+  def fail(self):
+    with self.condition:
+      self.failed = True
+      self.condition.notify_all()
+
+class ParallelDownload:
+  """Downloads the file as `streams` ranged sub-transfers at the same time, each from a UDP socket of its own.
+
+  Each stream takes the next chunk from a ChunkSchedule and fetches it with a
+  GET for its line range, on a new socket per chunk so that late packets of a
+  finished chunk cannot be mistaken for the next one. `new_emulator` gives the
+  emulator of a socket; the emulators share the links, so the streams compete
+  for the same bottleneck. Used like an emulator: run() takes the client whose
+  output file and options the download uses.
+  """
+  def __init__(self,server_address,streams,chunk_lines,new_emulator,round_time,tracer=NULL_TRACER):
+    self.server_address = server_address
+    self.streams = streams
+    self.chunk_lines = chunk_lines
+    self.new_emulator = new_emulator
+    self.round_time = round_time
+    self.tracer = tracer
+    self.lock = threading.Lock()
+    self.server_packets = 0
+    self.ecn_packets = 0
+    self.additional_packets = 0
+    self.retired = []  # (socket, time) of finished chunks, still listened to for additional server packets
+    self.start_time = None
+    self.finish_time = None
+
+  def rounds(self):
+    return int((self.finish_time - self.start_time) / self.round_time) + 1
+
+  def run(self,client,rtx_timeout,max_rtx):
+    # returns whether every chunk was transferred
+    self.start_time = time.time()
+    (start,_,end) = (client.line_range or "0").partition("-")
+    schedule = ChunkSchedule(client.outfile,self.chunk_lines,int(start),int(end) if end else None,2 * self.streams)
+    threads = [threading.Thread(target=self.run_stream,args=(client,schedule,rtx_timeout,max_rtx))
+               for _ in range(self.streams)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.finish_time = time.time()
+    return not schedule.failed
+
+  def run_stream(self,client,schedule,rtx_timeout,max_rtx):
+    while True:
+      try:
+        chunk = schedule.claim()
+        if chunk is None:
+          return
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.bind((client.ownipaddr,0))
+        (ipaddr,port) = sock.getsockname()
+        output = io.BytesIO()
+        chunk_client = Client(ipaddr,port,output,client.multi_line_segments,client.sack,"never",False,self.tracer,
+                              "{}-{}".format(*schedule.bounds(chunk)),integrity=client.integrity,
+                              compress=client.compress)
+        emulator = self.new_emulator(sock)
+        finished = emulator.run(chunk_client,rtx_timeout,max_rtx)
+        with self.lock:
+          self.server_packets += emulator.server_packets
+          self.ecn_packets += emulator.ecn_packets
+        self.retire(sock)
+        if not finished:
+          schedule.fail()
+          return
+        schedule.deliver(chunk,output.getvalue())
+      except BaseException:
+        schedule.fail()  # or the other streams would wait for this chunk forever
+        raise
+
+  def count_packets(self,sock):
+    while True:
+      try:
+        (data,sender_address) = sock.recvfrom(512)
+      except BlockingIOError:
+        return
+      if sender_address == self.server_address:
+        self.additional_packets += 1
+        self.tracer.packet("additional",data)
+
+  def retire(self,sock):
+    # close the sockets of the chunks that finished long enough ago, instead of keeping one per chunk open
+    with self.lock:
+      now = time.time()
+      for (old_sock,retired_at) in self.retired:
+        if now - retired_at >= additional_packets_timeout:
+          self.count_packets(old_sock)
+          old_sock.close()
+      self.retired = [(old_sock,retired_at) for (old_sock,retired_at) in self.retired
+                      if now - retired_at < additional_packets_timeout]
+      self.retired.append((sock,now))
+
+  def count_additional_server_packets(self,waiting_timeout=additional_packets_timeout):
+    # count_additional_server_packets over the sockets of the chunks
+    sockets = [sock for (sock,_) in self.retired]
+    deadline = time.time() + waiting_timeout
+    while sockets and time.time() < deadline:
+      (readable,_,_) = select.select(sockets,[],[],deadline - time.time())
+      for sock in readable:
+        self.count_packets(sock)
+    for sock in sockets:
+      sock.close()
+    self.retired = []
+    return self.additional_packets
 
 ####################
 # Helper functions #
 ####################
 
+def resume_point(filename):
+  # number of complete lines in an earlier, interrupted output file; a partly written last line is cut off
+  if not os.path.exists(filename):
+    return 0
+  with open(filename,"r+b") as f:
+    lines = 0
+    complete_size = 0
+    offset = 0
+    for chunk in iter(lambda: f.read(output_buffer_size),b""):
+      newlines = chunk.count(b"\n")
+      if newlines:
+        lines += newlines
+        complete_size = offset + chunk.rfind(b"\n") + 1
+      offset += len(chunk)
+    f.truncate(complete_size)
+  return lines
+
+def get_line_range(options,outfilename):
+  # what to put in the GET: None for the whole file, else "START[-END]"
+  if not options.resume:
+    return options.line_range
+  (start,_,end) = (options.line_range or "0").partition("-")
+  start = int(start) + resume_point(outfilename)
+  return "{}-{}".format(start,end) if end else str(start)
+
+def check_line_range(option, opt_str, value, parser):
+  if not re.fullmatch(r"\d+(-\d+)?",value):
+    raise OptionValueError("line range must be START or START-END, e.g. 100-199")
+  parser.values.line_range = value
+
 def _get_id(socket_address):
   return "[{}:{}]".format(socket_address[0],socket_address[1])
 
-def check_integrity(string,checksum):
-  return checksum == hashlib.md5(string.encode()).hexdigest()
-
 def check_port(option, opt_str, value, parser):
-  if value < 32768 or value > 61000:
-    raise OptionValueError("need 32768 <= port <= 61000")
+  if value != 0 and (value < 32768 or value > 61000):    # 0 lets the system pick a free port
+    raise OptionValueError("need 32768 <= port <= 61000, or 0")
   parser.values.port = value
 
 def check_address(option, opt_str, value, parser):
@@ -195,6 +893,53 @@ def setup_option_parser():
   parser.add_option("-o", "--output-file", dest="outfile_string", type="string",
                     action="store", default=default_outfile_string,
                     help="output filename (default: {})".format(default_outfile_string))
+  parser.add_option("--range", dest="line_range", type="string", action="callback", callback=check_line_range,
+                    metavar="START[-END]", default=None,
+                    help="only get lines START to END, both included and counted from 0, or START to the end of "
+                         "the file")
+  parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                    help="append to the lines the output file already has instead of starting over, and keep "
+                         "them if the transfer fails")
+  parser.add_option("--streams", dest="streams", type="int", default=default_streams, metavar="K",
+                    help="download K chunks of the file at the same time, each with a ranged GET from a socket of "
+                         "its own; needs --emulator=link (default: {})".format(default_streams))
+  parser.add_option("--chunk-lines", dest="chunk_lines", type="int", default=default_chunk_lines, metavar="N",
+                    help="lines per chunk with --streams (default: {})".format(default_chunk_lines))
+  parser.add_option("--multi-line-segments", dest="multi_line_segments", action="store_true", default=False,
+                    help="ask the server to pack as many lines as fit into each packet")
+  parser.add_option("--compress", dest="compress", action="store_true", default=False,
+                    help="ask the server for segments of lines compressed with zlib, each decodable on its own")
+  parser.add_option("--sack", dest="sack", action="store_true", default=False,
+                    help="buffer out-of-order packets and report them to the server with selective ACKs")
+  parser.add_option("--integrity", dest="integrity", type="choice", choices=list(INTEGRITY_CHECKS),
+                    default=DEFAULT_INTEGRITY,
+                    help="integrity check to ask the server for: {} (default: {}); a server that does not know it "
+                         "keeps sending MD5".format(", ".join(INTEGRITY_CHECKS),DEFAULT_INTEGRITY))
+  parser.add_option("--fsync", dest="fsync_policy", type="choice", choices=["never","end","always"],
+                    default=default_fsync_policy,
+                    help="when to fsync the output file: never, end of the transfer, or always after "
+                         "new lines are acknowledged (default: {})".format(default_fsync_policy))
+  parser.add_option("--emulator", dest="emulator", type="choice", choices=["rounds","link"], default="rounds",
+                    help="rounds: release queued packets once per queuing delay, link: event-driven link with "
+                         "bandwidth, propagation delay and loss, for high packet rates (default: rounds)")
+  parser.add_option("--bandwidth", dest="bandwidth", type="float", default=0, metavar="BYTES_PER_S",
+                    help="link bandwidth in each direction with --emulator=link; the server buffer options need "
+                         "it (default: no limit)")
+  parser.add_option("--propagation-delay", dest="propagation_delay", type="float", default=0, metavar="SECONDS",
+                    help="one-way propagation delay with --emulator=link (default: 0)")
+  parser.add_option("--loss-rate", dest="loss_rate", type="float", default=0,
+                    help="probability of losing each packet with --emulator=link (default: 0)")
+  parser.add_option("--gilbert-elliott", dest="gilbert_elliott", type="string", default=None,
+                    metavar="P_GOOD_TO_BAD,P_BAD_TO_GOOD[,LOSS_IN_BAD]",
+                    help="bursty loss with --emulator=link, instead of --loss-rate")
+  parser.add_option("--seed", dest="seed", type="int", default=None,
+                    help="random seed of the emulated loss")
+  parser.add_option("--quiet", dest="quiet", action="store_true", default=False,
+                    help="do not print every packet the client receives")
+  parser.add_option("--stats-file", dest="stats_file", type="string", default=None, metavar="FILE",
+                    help="also write the final stats to FILE as JSON")
+  parser.add_option("--trace", dest="trace_file", type="string", default=None, metavar="FILE",
+                    help="write what happens to every packet in the emulated network to FILE as JSON lines")
   parser.add_option("--drop-client-packets", dest="dropclpkts", type="string", action="store", default=None)
   parser.add_option("--drop-server-packets", dest="dropsrvpkts", type="string", action="store", default=None)
   parser.add_option("--generate-three-dup-acks", dest="threeacks", type="string", action="store", default="")
@@ -206,8 +951,8 @@ def setup_option_parser():
                     (e.g., +1@2,-2@5)")
   return parser
 
-def setup_packet_processor(options):
-  network_processing = PacketProcessor()
+def setup_packet_processor(options,packet_processor=PacketProcessor):
+  network_processing = packet_processor()
   if options.dropclpkts:
     clientpkts2drop = list(options.dropclpkts.split(","))
     network_processing.set_client_pkts_to_drop(clientpkts2drop)
@@ -232,24 +977,45 @@ def setup_buffers(options):
     queuing_delay = float(options.queuingdel)
   return (client_buffer,server_buffer,server_buffer_changes,queuing_delay)
 
-def simulate_network_queuing(queuing_delay,client_buffer,server_buffer):
-  init_time = time.time()
-  run_queuing_cycle(init_time,queuing_delay,client_buffer,server_buffer)
+def setup_links(options,link=Link):
+  rng = random.Random(options.seed)
+  def loss_model():
+    if options.gilbert_elliott:
+      parameters = [float(value) for value in options.gilbert_elliott.split(",")]
+      return GilbertElliottLoss(parameters[0],parameters[1],parameters[2] if len(parameters) > 2 else 1.0,rng)
+    if options.loss_rate > 0:
+      return RandomLoss(options.loss_rate,rng)
+    return None
+  to_server = link(options.bandwidth,options.propagation_delay,loss=loss_model())
+  to_client = link(options.bandwidth,options.propagation_delay,loss=loss_model())
+  return (to_server,to_client)
+
+def link_round_time(to_server,to_client):
+  # a round of the link emulation is one base RTT
+  return max(to_server.delay + to_client.delay,min_round_time)
+
+def setup_link_emulator(options,network_processing,acks2triple,server_buffer,server_buffer_changes,tracer=NULL_TRACER):
+  (to_server,to_client) = setup_links(options)
+  server_rounds = ServerRounds(to_client,server_buffer,server_buffer_changes,link_round_time(to_server,to_client))
+  return LinkEmulator(sock,server_address,network_processing,acks2triple,server_rounds,to_server,to_client,tracer)
 
-def run_queuing_cycle(init_time,queuing_delay,client_buffer,server_buffer):
-  try:
-    elapsed_time = 0
-    while elapsed_time <= queuing_delay:
-      if queuing_delay > 0:
-        sock.settimeout(queuing_delay - elapsed_time)
+def count_additional_server_packets(sock,server_address,waiting_timeout=additional_packets_timeout,clock=time.time,
+                                    tracer=NULL_TRACER):
+  sock.setblocking(True)
+  additional_srv_packets = 0
+  elapsed_time = 0
+  init_time = clock()
+  while waiting_timeout > elapsed_time:
+    try:
+      sock.settimeout(waiting_timeout - elapsed_time)
       (data, sender_address,) = sock.recvfrom(512)
-      if sender_address != server_address:    # data from client
-        client_buffer.enqueue(data, sender_address)
-      else:                                   # data from server
-        server_buffer.enqueue(data, sender_address)
-      elapsed_time = time.time() - init_time
-  except socket.timeout:
-    pass
+      if sender_address == server_address:    # data from server
+        additional_srv_packets += 1
+        tracer.packet("additional",data)
+      elapsed_time = clock() - init_time
+    except socket.timeout:
+      break
+  return additional_srv_packets
 
 start_time = None
 finish_time = None
@@ -261,6 +1027,7 @@ def output_stats():
   diffcmd.wait()
   if errors:
     raise Exception("errors while running diff:\n{}".format(errors))
+  difflines = 0
   if len(output) == 0:
     print("# different lines in client file --> 0")
   else:
@@ -275,6 +1042,12 @@ def output_stats():
   print("# server packets after the file transfer completed --> {}".format(additional_srv_packets))
   print("# Total time to complete transfer --> {} seconds".format(finish_time - start_time))
   sys.stdout.flush()
+  if options.stats_file:
+    # same names as the metrics of simulation.simulate()
+    with open(options.stats_file,"w") as f:
+      json.dump({"different_lines": difflines,"ecn_packets": tot_ecn_packets,"server_packets": tot_srv_packets,
+                 "rounds": total_rounds,"additional_packets": additional_srv_packets,
+                 "time": finish_time - start_time},f)
 
 ########
 # Main #
@@ -286,6 +1059,13 @@ if __name__ == "__main__":
   # parse CLI arguments
   parser = setup_option_parser()
   (options, args) = parser.parse_args()
+  if options.streams > 1 and options.emulator != "link":
+    parser.error("--streams needs --emulator=link")
+  if options.streams < 1 or options.chunk_lines < 1:
+    parser.error("--streams and --chunk-lines must be at least 1")
+  if options.emulator == "link" and not options.bandwidth and (options.srvbuffersize or options.srvbufferchanges):
+    # without a bandwidth limit every packet leaves the queue as it arrives, so no buffer size would ever bounce one
+    parser.error("--set-server-buffer-size and --set-server-buffer-size-changes need --bandwidth with --emulator=link")
 
   # process general options
   outfilename = options.outfile_string
@@ -302,120 +1082,48 @@ if __name__ == "__main__":
   sys.stdout.flush()
 
   # setup client variables
-  client = Client(ownipaddr,ownport)
+  tracer = Tracer(options.trace_file) if options.trace_file else NULL_TRACER
+  client = Client(ownipaddr,ownport,outfilename,options.multi_line_segments,options.sack,options.fsync_policy,
+                  not options.quiet,tracer,get_line_range(options,outfilename),options.resume,options.integrity,
+                  options.compress)
   transfer_finished = False
 
   # setup network buffers and packet processing
   acks2triple = list(options.threeacks.split(","))
-  network_processing = setup_packet_processor(options)
+  network_processing = setup_packet_processor(options,SharedPacketProcessor if options.streams > 1 else PacketProcessor)
   (client_buffer,server_buffer,server_buffer_changes,queuing_delay) = setup_buffers(options)
-  
-  # initialise data structures for stats tracking
-  client_packet_no = 0
-  tot_srv_packets = 0
-  tot_ecn_packets = 0
-  client_in_curr_round = False
-  transmission_started = False
-  total_rounds = 0
-  server_packet_rounds = 0
+  if options.streams > 1:
+    # the streams share the links, the packet counts and the rounds, as one transfer would
+    (to_server,to_client) = setup_links(options,SharedLink)
+    round_time = link_round_time(to_server,to_client)
+    server_rounds = SharedServerRounds(to_client,server_buffer,server_buffer_changes,round_time)
+    new_emulator = lambda stream_sock: LinkEmulator(stream_sock,server_address,network_processing,acks2triple,
+                                                    server_rounds,to_server,to_client,tracer)
+    emulator = ParallelDownload(server_address,options.streams,options.chunk_lines,new_emulator,round_time,tracer)
+  elif options.emulator == "link":
+    emulator = setup_link_emulator(options,network_processing,acks2triple,server_buffer,server_buffer_changes,tracer)
+  else:
+    emulator = RoundsEmulator(sock,server_address,network_processing,acks2triple,client_buffer,server_buffer,
+                              server_buffer_changes,queuing_delay,verbose=not options.quiet,tracer=tracer)
 
   # start transfer and process packets, simulating both queuing/congestion in the network and processing at the client
-  next_rtx = time.time() + client_rtx_timeout
-  curr_rtx = 0
-  last_transmitted = client.start_transfer(client_buffer)
-  while True:
-    # print(f"Buffers before queueing client buffer: {client_buffer} server: {server_buffer}\n")
-    simulate_network_queuing(queuing_delay,client_buffer,server_buffer)
-    # print(f"STARTING TRANSMISSION   client buffer: {client_buffer} server: {server_buffer}\n")
-    if transmission_started:
-      total_rounds += 1
-    # deal with cases where there is no packet to send or receive, checking if the clients want to retransmit or to give up
-    if client_buffer.is_empty() and server_buffer.is_empty():
-      if curr_rtx >= max_no_rtx:
-        print("\nERROR: failed transfer, server not responding anymore")
-        client.set_failed_transfer()
-        break
-      if time.time() > next_rtx:
-        client_buffer.enqueue(last_transmitted,(ownipaddr,ownport))
-        curr_rtx += 1
-      else:
-        continue
-    print()
-    # process data from client
-    for (data,sender_address,send_back) in client_buffer.dequeue():
-      transmission_started = True
-      fwd_data = network_processing.process_client_packet(data)
-      destination = server_address
-      if send_back:
-        destination = sender_address
-      if fwd_data:
-        last_transmitted = fwd_data
-        next_rtx = time.time() + client_rtx_timeout
-        client_in_curr_round = True
-        if "ACK" in fwd_data.decode() and str(client_packet_no+1) in acks2triple:
-          network_processing.change_ack_number(data,-1)
-          for i in range(3):
-            print("Forwarding {} from {} to {}".format(fwd_data,sender_address,destination))
-            sock.sendto(fwd_data,destination)
-            client_packet_no += 1
-          break
-        else:
-          print("Forwarding {} from {} to {}".format(fwd_data,sender_address,destination))
-          sock.sendto(fwd_data,destination)
-          client_packet_no += 1
-      else:
-        print("Dropped client packet {}".format(data))
-
-    # process data from server
-    iteration_with_srv_packets = False
-    curr_forwarded = 0
-    for (origin_data,sender_address,send_back) in server_buffer.dequeue():
-      client_in_curr_round = True
-      (_,data) = network_processing.process_server_packet(origin_data)
-      if not data:
-        print("Dropped server packet {}".format(origin_data))
-        continue
-      if send_back:
-        print("Forwarding back ECN packet {}".format(origin_data))
-        sock.sendto(origin_data,server_address)
-        tot_ecn_packets += 1
-      elif str(client_packet_no + 1 + curr_forwarded) in acks2triple:
-        print("Dropped server packet {}".format(data))
-        curr_forwarded += 1
-      else:
-        iteration_with_srv_packets = True
-        curr_rtx = 0
-        curr_forwarded += 1
-        transfer_finished = client.process_server_packet(data,client_buffer)
-      tot_srv_packets += 1
-    # adjust buffer size if needed
-    if iteration_with_srv_packets:
-      server_packet_rounds += 1
-    if server_packet_rounds in server_buffer_changes:
-      server_buffer.set_size(server_buffer.get_size() + server_buffer_changes[server_packet_rounds])
-      server_buffer_changes.pop(server_packet_rounds)  # we must remove buffer size change, otherwise we would keep decreasing the buffer size until we get another server packet
-    # handle terminated connections
-    if transfer_finished:
-      break
+  if not emulator.run(client,client_rtx_timeout,max_no_rtx):
+    print("\nERROR: failed transfer, server not responding anymore")
+    client.set_failed_transfer()
+  tot_srv_packets = emulator.server_packets
+  tot_ecn_packets = emulator.ecn_packets
+  total_rounds = emulator.rounds()
 
   # checking if the server sends us additional (useless) packets
   finish_time = time.time()
   print("\nWaiting to fully close the connection...")
-  additional_srv_packets = 0
-  waiting_timeout = 2
-  elapsed_time = 0
-  init_time = time.time()
-  while waiting_timeout > elapsed_time:
-    try:
-      sock.settimeout(waiting_timeout - elapsed_time)
-      (data, sender_address,) = sock.recvfrom(512)
-      if sender_address == server_address:    # data from server
-        additional_srv_packets += 1
-      elapsed_time = time.time() - init_time
-    except socket.timeout:
-      break
+  if options.streams > 1:
+    additional_srv_packets = emulator.count_additional_server_packets()
+  else:
+    additional_srv_packets = count_additional_server_packets(sock,server_address,tracer=tracer)
 
   # final operations
-  client.write_file(outfilename)
+  client.close_output()
+  tracer.close()
   output_stats()
 
@@ -0,0 +1,253 @@
+import time
+
+INITIAL_SSTHRESH = 8
+INITIAL_CWND = 1
+
+ACKS_ON_MAX_WINDOW_THRESHOLD = 3
+
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+BBR_STARTUP_GAIN = 2.89
+BBR_DRAIN_GAIN = 1 / BBR_STARTUP_GAIN
+BBR_CWND_GAIN = 2
+BBR_PROBE_GAINS = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+BBR_BANDWIDTH_FILTER_ROUNDS = 10
+BBR_FULL_BANDWIDTH_GROWTH = 1.25
+BBR_FULL_BANDWIDTH_ROUNDS = 3
+BBR_ECN_BETA = 0.7
+BBR_MIN_CWND = 2
+
+
+class CongestionController:
+	"""Decides the congestion window of a single connection.
+
+	The connection reports events through the on_* hooks and reads back `cwnd`,
+	in packets, and `pacing_rate`, in packets per second (None when unpaced).
+	Timer expiries are treated as random loss: in this network congestion is
+	signalled by ECN.
+	"""
+
+	def __init__(self, clock=time.monotonic):
+		self.clock = clock
+		self.cwnd = INITIAL_CWND
+		self.ssthresh = INITIAL_SSTHRESH
+
+	@property
+	def pacing_rate(self):
+		return None
+
+	def seed(self, cwnd, ssthresh):
+		"""Start from what an earlier connection on the same path learned."""
+		self.cwnd = cwnd
+		self.ssthresh = ssthresh
+
+	def on_ack(self, acked, rtt_sample):
+		"""A new cumulative ACK covering `acked` more packets arrived.
+
+		`rtt_sample` is None when the ACK does not give a usable RTT measurement.
+		"""
+
+	def on_dup_ack(self):
+		"""An ACK that did not move the window arrived."""
+
+	def on_fast_retransmit(self):
+		"""Enough duplicate ACKs arrived to resend the window from the hole."""
+
+	def on_ecn(self):
+		"""A packet came back with an ECN mark."""
+
+	def on_timeout(self):
+		"""A retransmission timer fired."""
+
+
+class DefaultController(CongestionController):
+	"""Grow by one packet per window of ACKs up to `ssthresh`, then raise `ssthresh`
+	by one every ACKS_ON_MAX_WINDOW_THRESHOLD windows."""
+	name = "default"
+
+	def __init__(self, clock=time.monotonic):
+		super().__init__(clock)
+		self.acks_received = 0
+		self.acks_on_max_window = 0
+
+	def on_ack(self, acked, rtt_sample):
+		self.acks_received += 1
+		if self.acks_received >= self.cwnd:
+			if self.cwnd < self.ssthresh:
+				self.cwnd += 1
+				self.acks_received = 0
+			else:
+				self.acks_on_max_window += 1
+				if self.acks_on_max_window >= ACKS_ON_MAX_WINDOW_THRESHOLD:
+					self.ssthresh += 1
+					self.cwnd = self.ssthresh
+					self.acks_received = 0
+					self.acks_on_max_window = 0
+
+	def on_dup_ack(self):
+		self.acks_received += 1
+
+	def on_fast_retransmit(self):
+		# from csw, doesn't imply congestion
+		self.acks_received = 0
+
+	def on_ecn(self):
+		self.ssthresh = max(self.cwnd - 1, 1)
+		self.cwnd = max(1, self.ssthresh - 1)
+		self.acks_on_max_window = 0
+		self.acks_received = 0
+
+	def on_timeout(self):
+		self.acks_received = 0
+		self.acks_on_max_window = 0
+
+
+class CubicController(CongestionController):
+	"""CUBIC (RFC 8312): after a reduction the window follows a cubic curve that
+	flattens around the size it had at the last congestion event."""
+	name = "cubic"
+
+	def __init__(self, clock=time.monotonic):
+		super().__init__(clock)
+		self.window = float(INITIAL_CWND)
+		self.w_max = 0.0
+		self.w_est = 0.0
+		self.k = 0.0
+		self.epoch_start = None
+		self.min_rtt = None
+		self.last_rtt = 0.0
+		self.reduction_time = None
+
+	@property
+	def cwnd(self):
+		return max(1, int(self.window))
+
+	@cwnd.setter
+	def cwnd(self, value):
+		self.window = float(value)
+
+	def on_ack(self, acked, rtt_sample):
+		if rtt_sample is not None:
+			self.last_rtt = rtt_sample
+			self.min_rtt = rtt_sample if self.min_rtt is None else min(self.min_rtt, rtt_sample)
+		if self.window < self.ssthresh:
+			self.window += acked
+			return
+
+		now = self.clock()
+		if self.epoch_start is None:
+			self.epoch_start = now
+			self.w_est = self.window
+			if self.window < self.w_max:
+				self.k = ((self.w_max - self.window) / CUBIC_C) ** (1 / 3)
+			else:
+				self.k = 0.0
+				self.w_max = self.window
+
+		t = now - self.epoch_start + (self.min_rtt or 0)
+		target = self.w_max + CUBIC_C * (t - self.k) ** 3
+		if target > self.window:
+			self.window += acked * (target - self.window) / self.window
+		else:
+			self.window += acked * 0.01 / self.window
+
+		# never grow slower than standard TCP would
+		self.w_est += acked * 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) / self.window
+		self.window = max(self.window, self.w_est)
+
+	def on_ecn(self):
+		# every marked packet of the same window comes back, reduce once per RTT
+		now = self.clock()
+		if self.reduction_time is not None and now - self.reduction_time < self.last_rtt:
+			return
+		self.reduction_time = now
+		self.epoch_start = None
+		self.w_max = self.window
+		self.window = max(1.0, self.window * CUBIC_BETA)
+		self.ssthresh = self.window
+
+
+class BBRController(CongestionController):
+	"""BBR-style model based control: the window and pacing rate follow the
+	estimated bottleneck bandwidth and minimum RTT rather than losses."""
+	name = "bbr"
+
+	def __init__(self, clock=time.monotonic):
+		super().__init__(clock)
+		self.state = "startup"
+		self.bandwidth_samples = []  # max delivery rate (packets/s) of the last rounds
+		self.min_rtt = None
+		self.round_start = None
+		self.round_delivered = 0
+		self.full_bandwidth = 0.0
+		self.full_bandwidth_rounds = 0
+		self.probe_index = 0
+
+	@property
+	def bandwidth(self):
+		return max(self.bandwidth_samples) if self.bandwidth_samples else 0.0
+
+	@property
+	def pacing_gain(self):
+		if self.state == "startup":
+			return BBR_STARTUP_GAIN
+		if self.state == "drain":
+			return BBR_DRAIN_GAIN
+		return BBR_PROBE_GAINS[self.probe_index]
+
+	@property
+	def pacing_rate(self):
+		if not self.bandwidth:
+			return None
+		return self.pacing_gain * self.bandwidth
+
+	def on_ack(self, acked, rtt_sample):
+		now = self.clock()
+		if rtt_sample is not None:
+			self.min_rtt = rtt_sample if self.min_rtt is None else min(self.min_rtt, rtt_sample)
+		if self.min_rtt is None:  # nothing to measure rounds with yet
+			self.cwnd += acked
+			return
+		if self.round_start is None:
+			self.round_start = now
+		self.round_delivered += acked
+
+		if now - self.round_start >= self.min_rtt:
+			self.end_round(self.round_delivered / (now - self.round_start))
+			self.round_start = now
+			self.round_delivered = 0
+
+		if self.state == "startup" and not self.bandwidth:
+			self.cwnd += acked  # no estimate yet, grow like slow start
+		else:
+			gain = BBR_STARTUP_GAIN if self.state == "startup" else BBR_CWND_GAIN
+			self.cwnd = max(BBR_MIN_CWND, round(gain * self.bandwidth * self.min_rtt))
+
+	def end_round(self, delivery_rate):
+		self.bandwidth_samples.append(delivery_rate)
+		del self.bandwidth_samples[:-BBR_BANDWIDTH_FILTER_ROUNDS]
+
+		if self.state == "startup":
+			if self.bandwidth >= self.full_bandwidth * BBR_FULL_BANDWIDTH_GROWTH:
+				self.full_bandwidth = self.bandwidth
+				self.full_bandwidth_rounds = 0
+			else:
+				self.full_bandwidth_rounds += 1
+				if self.full_bandwidth_rounds >= BBR_FULL_BANDWIDTH_ROUNDS:
+					self.state = "drain"
+		elif self.state == "drain":
+			self.state = "probe_bw"
+		else:
+			self.probe_index = (self.probe_index + 1) % len(BBR_PROBE_GAINS)
+
+	def on_ecn(self):
+		# the queue is building up: the bandwidth estimate is too high
+		self.bandwidth_samples = [sample * BBR_ECN_BETA for sample in self.bandwidth_samples]
+		if self.state == "startup":
+			self.state = "drain"
+		self.cwnd = max(BBR_MIN_CWND, int(self.cwnd * BBR_ECN_BETA))
+
+
+CONGESTION_CONTROLLERS = {controller.name: controller for controller in
+                          (DefaultController, CubicController, BBRController)}
@@ -0,0 +1,28 @@
+import hashlib, zlib
+
+DEFAULT_INTEGRITY = "md5"
+
+
+def md5(data):
+	return hashlib.md5(data).hexdigest().encode()
+
+
+def blake2b(data):
+	# truncated to 64 bits: enough against corruption, which is all the check is for
+	return hashlib.blake2b(data, digest_size=8).hexdigest().encode()
+
+
+def crc32(data):
+	return b"%08x" % zlib.crc32(data)
+
+
+# name a client asks for in its GET -> checksum of a payload, as hex digits
+INTEGRITY_CHECKS = {"md5": md5, "blake2b": blake2b, "crc32": crc32}
+
+# every check has a length of its own, so a packet tells which one it carries
+CHECKS_BY_LENGTH = {len(check(b"")): check for check in INTEGRITY_CHECKS.values()}
+
+
+def check_integrity(content, checksum):
+	check = CHECKS_BY_LENGTH.get(len(checksum))
+	return check is not None and check(content) == checksum
@@ -0,0 +1,151 @@
+import os, bisect
+
+RETRANSMIT_CAUSES = ("timer", "dup_ack", "ecn", "rack", "probe")
+
+RTT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)  # seconds
+ACK_PROCESSING_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)  # seconds
+
+METRIC_PREFIX = "rudp_"
+
+# the type and help text of each metric family, in the order they are rendered
+FAMILIES = {
+	"packets_sent_total": ("counter", "Packets sent, retransmissions included."),
+	"bytes_sent_total": ("counter", "Bytes sent, retransmissions included."),
+	"acks_total": ("counter", "ACKs received."),
+	"duplicate_acks_total": ("counter", "Duplicate ACKs received."),
+	"ecn_marks_total": ("counter", "ECN marks received."),
+	"retransmits_total": ("counter", "Retransmissions, by cause."),
+	"rtt_seconds": ("histogram", "RTT samples."),
+	"ack_processing_seconds": ("histogram", "Time spent processing each ACK."),
+	"cwnd": ("gauge", "Congestion window, in packets."),
+	"ssthresh": ("gauge", "Slow start threshold, in packets."),
+	"srtt_seconds": ("gauge", "Smoothed RTT."),
+	"rto_seconds": ("gauge", "Retransmission timeout."),
+	"last_ack": ("gauge", "Last ACK received."),
+	"connections_active": ("gauge", "Live connections."),
+	"connections_finished_total": ("counter", "Connections that ended."),
+}
+
+
+def series(name, *labels):
+	labels = ",".join(label for label in labels if label)
+	return "%s{%s}" % (name, labels) if labels else name
+
+
+class Histogram:
+	"""Observations counted in fixed buckets, exported as a Prometheus histogram."""
+	__slots__ = ("bounds", "counts", "count", "sum")
+
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def merge(self, other):
+		for i, count in enumerate(other.counts):
+			self.counts[i] += count
+		self.count += other.count
+		self.sum += other.sum
+
+	def render(self, name, labels):
+		lines = []
+		cumulative = 0
+		for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+			cumulative += count
+			lines.append("%s %d" % (series(name + "_bucket", labels, 'le="%s"' % bound), cumulative))
+		lines.append("%s %s" % (series(name + "_sum", labels), self.sum))
+		lines.append("%s %d" % (series(name + "_count", labels), self.count))
+		return lines
+
+
+class ConnectionMetrics:
+	"""Counters and histograms of a single connection.
+
+	The connection updates them as it goes, with plain attribute increments
+	only; gauges such as the window and RTT estimate are read from the
+	connection when the metrics are rendered.
+	"""
+
+	def __init__(self):
+		self.packets_sent = 0
+		self.bytes_sent = 0
+		self.retransmits = dict.fromkeys(RETRANSMIT_CAUSES, 0)
+		self.acks = 0
+		self.duplicate_acks = 0
+		self.ecn_marks = 0
+		self.rtt = Histogram(RTT_BUCKETS)
+		self.ack_processing = Histogram(ACK_PROCESSING_BUCKETS)
+
+	def on_send(self, size, retransmit_cause=None):
+		self.packets_sent += 1
+		self.bytes_sent += size
+		if retransmit_cause is not None:
+			self.retransmits[retransmit_cause] += 1
+
+	def merge(self, other):
+		for name in ("packets_sent", "bytes_sent", "acks", "duplicate_acks", "ecn_marks"):
+			setattr(self, name, getattr(self, name) + getattr(other, name))
+		for cause, count in other.retransmits.items():
+			self.retransmits[cause] += count
+		self.rtt.merge(other.rtt)
+		self.ack_processing.merge(other.ack_processing)
+
+	def render(self, families, labels=""):
+		"""Adds the series to `families`, the lines of each family by name."""
+		for name in ("packets_sent", "bytes_sent", "acks", "duplicate_acks", "ecn_marks"):
+			families[name + "_total"].append("%s %d" % (series(METRIC_PREFIX + name + "_total", labels), getattr(self, name)))
+		for cause, count in self.retransmits.items():
+			families["retransmits_total"].append("%s %d" % (series(METRIC_PREFIX + "retransmits_total", labels,
+			                                                        'cause="%s"' % cause), count))
+		families["rtt_seconds"] += self.rtt.render(METRIC_PREFIX + "rtt_seconds", labels)
+		families["ack_processing_seconds"] += self.ack_processing.render(METRIC_PREFIX + "ack_processing_seconds", labels)
+
+
+class ServerMetrics:
+	"""Totals over every connection the server had, plus the state of the live ones."""
+
+	def __init__(self):
+		self.finished = ConnectionMetrics()  # what the connections that already ended added up to
+		self.connections_finished = 0
+
+	def connection_ended(self, metrics):
+		self.finished.merge(metrics)
+		self.connections_finished += 1
+
+	def render(self, connections):
+		"""Prometheus text format, `connections` being the live connections by client id."""
+		total = ConnectionMetrics()
+		total.merge(self.finished)
+		families = {name: [] for name in FAMILIES}  # the series of a family must follow each other
+		for client_id, connection in sorted(connections.items()):
+			total.merge(connection.metrics)
+			labels = 'client="%s"' % client_id.strip("[]")
+			connection.metrics.render(families, labels)
+			for name, value in connection.gauges().items():
+				if value is not None:
+					families[name].append("%s %s" % (series(METRIC_PREFIX + name, labels), value))
+		families["connections_active"].append("%sconnections_active %d" % (METRIC_PREFIX, len(connections)))
+		families["connections_finished_total"].append("%sconnections_finished_total %d"
+		                                              % (METRIC_PREFIX, self.connections_finished))
+		# without the client label, the metrics of the whole server
+		total.render(families)
+		lines = []
+		for name, (metric_type, help_text) in FAMILIES.items():
+			if families[name]:
+				lines.append("# HELP %s%s %s" % (METRIC_PREFIX, name, help_text))
+				lines.append("# TYPE %s%s %s" % (METRIC_PREFIX, name, metric_type))
+				lines += families[name]
+		return "\n".join(lines) + "\n"
+
+	def dump(self, filename, connections):
+		# replaced in one step, so a reader never sees a half written file
+		tmp_filename = "{}.{}".format(filename, os.getpid())
+		with open(tmp_filename, "w") as f:
+			f.write(self.render(connections))
+		os.replace(tmp_filename, filename)
@@ -0,0 +1,79 @@
+import os, json, time, ipaddress, collections
+from congestion import INITIAL_CWND
+
+default_path_cache_ttl = 600  # seconds
+default_path_cache_prefix = 32  # every IPv4 host is a path of its own
+
+MAX_SEEDED_CWND = 10  # at most the initial window of RFC 6928, whatever the last connection reached
+
+
+class PathMetrics(collections.namedtuple("PathMetrics", "rtt deviation ssthresh cwnd updated")):
+	"""What the last connection to a destination learned about the path.
+
+	`cwnd` is the initial window for the next connection, already made safe: half
+	of what the last one ended with, at most MAX_SEEDED_CWND.
+	"""
+	__slots__ = ()
+
+
+class PathCache:
+	"""The path metrics of the last `capacity` destinations, least recently used
+	evicted first, in the spirit of the TCP control block sharing of RFC 9040.
+
+	Destinations are the client IP addresses cut to `prefix_length` bits, so
+	that a whole subnet can share one entry. Entries older than `ttl` seconds
+	are not used, since the path may have changed since.
+	"""
+
+	def __init__(self, capacity, ttl=default_path_cache_ttl, prefix_length=default_path_cache_prefix,
+	             clock=time.time, filename=None):
+		self.capacity = capacity
+		self.ttl = ttl
+		self.prefix_length = prefix_length
+		self.clock = clock
+		self.filename = filename
+		self.entries = collections.OrderedDict()  # destination -> PathMetrics, least recently used first
+		if filename is not None and os.path.exists(filename):
+			self.load()
+
+	def destination(self, ip):
+		return str(ipaddress.ip_network("{}/{}".format(ip, self.prefix_length), strict=False))
+
+	def get(self, ip):
+		"""The metrics of the path to `ip`, None if unknown or expired."""
+		key = self.destination(ip)
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		if self.clock() - entry.updated > self.ttl:
+			del self.entries[key]
+			return None
+		self.entries.move_to_end(key)
+		return entry
+
+	def update(self, ip, rtt, deviation, ssthresh, cwnd):
+		"""Remember the state a connection to `ip` ended with."""
+		key = self.destination(ip)
+		self.entries.pop(key, None)
+		self.entries[key] = PathMetrics(rtt, deviation, ssthresh, min(MAX_SEEDED_CWND, max(INITIAL_CWND, cwnd // 2)),
+		                                self.clock())
+		while len(self.entries) > self.capacity:
+			self.entries.popitem(last=False)
+
+	def load(self):
+		with open(self.filename) as f:
+			entries = json.load(f)
+		now = self.clock()
+		for key, values in entries:
+			entry = PathMetrics(*values)
+			if now - entry.updated <= self.ttl:
+				self.entries[key] = entry
+		while len(self.entries) > self.capacity:
+			self.entries.popitem(last=False)
+
+	def save(self):
+		# replaced in one step, like the metrics file
+		tmp_filename = "{}.{}".format(self.filename, os.getpid())
+		with open(tmp_filename, "w") as f:
+			json.dump(list(self.entries.items()), f)
+		os.replace(tmp_filename, self.filename)
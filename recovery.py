@@ -0,0 +1,73 @@
+INITIAL_RTO = 5
+MIN_RTO = 0.2
+MAX_RTO = 60
+MAX_BACKOFFS = 8  # 2 ** 8 times the RTO is already past MAX_RTO for any RTT seen here
+
+NEW_RTT_WEIGHT = 0.1
+NEW_DEVIATION_WEIGHT = 0.125
+DEVIATIONS_IN_TIMEOUT = 6
+
+REORDERING_WINDOW_FRACTION = 0.25  # of the minimum RTT
+PROBE_TIMEOUT_RTTS = 2
+
+
+class LossRecovery:
+	"""Retransmission timeout and loss detection timing of a single connection.
+
+	The RTO follows RFC 6298: it is estimated only from packets that were not
+	retransmitted (Karn's algorithm), doubles on every expiry until a new valid
+	sample arrives and stays within [MIN_RTO, MAX_RTO]. On top of it, RACK-TLP
+	(RFC 8985) gives the time-based rules: a packet counts as lost once a packet
+	sent after it was delivered and it has been outstanding for an RTT plus a
+	reordering window, and a tail loss probe goes out when a whole flight stays
+	unacknowledged for two RTTs.
+	"""
+
+	def __init__(self):
+		self.rtt = None
+		self.deviation = None
+		self.min_rtt = None
+		self.backoffs = 0
+
+	@property
+	def rto(self):
+		if self.rtt is None:
+			rto = INITIAL_RTO
+		else:
+			rto = max(MIN_RTO, self.rtt + DEVIATIONS_IN_TIMEOUT * self.deviation)
+		return min(MAX_RTO, rto * 2 ** self.backoffs)
+
+	@property
+	def reordering_window(self):
+		return REORDERING_WINDOW_FRACTION * self.min_rtt if self.min_rtt else 0
+
+	@property
+	def probe_timeout(self):
+		# None until there is an RTT to base it on, the RTO covers that time
+		if self.rtt is None:
+			return None
+		return min(PROBE_TIMEOUT_RTTS * self.rtt, self.rto)
+
+	def seed(self, rtt, deviation):
+		"""Start from the estimate of an earlier connection on the same path rather than INITIAL_RTO."""
+		self.rtt = rtt
+		self.deviation = deviation
+
+	def on_rtt_sample(self, rtt_sample):
+		# the caller only passes samples of packets that were sent once
+		if self.rtt is None:
+			self.rtt = rtt_sample
+			self.deviation = rtt_sample / 2
+		else:
+			self.rtt = NEW_RTT_WEIGHT * rtt_sample + (1 - NEW_RTT_WEIGHT) * self.rtt
+			deviation_sample = abs(rtt_sample - self.rtt)
+			self.deviation = NEW_DEVIATION_WEIGHT * deviation_sample + (1 - NEW_DEVIATION_WEIGHT) * self.deviation
+		self.min_rtt = rtt_sample if self.min_rtt is None else min(self.min_rtt, rtt_sample)
+		self.backoffs = 0
+
+	def on_timeout(self):
+		self.backoffs = min(self.backoffs + 1, MAX_BACKOFFS)
+
+	def loss_deadline(self, time_sent):
+		"""When a packet sent at `time_sent` counts as lost, once a later packet was delivered."""
+		return time_sent + self.rtt + self.reordering_window
@@ -1,4 +1,5 @@
-import subprocess
+import subprocess, sys, os, tempfile, time, json, shlex, concurrent.futures
+from optparse import OptionParser
 
 tests = [
 	['A1', 'python3 client.py --set-queue-delay=0.1 --drop-server-packets=4', 0, 0, 1000, 1000, 0],
@@ -28,6 +29,12 @@ def get_result(test, my_result):
 	return f"{OKGREEN}PASSED{ENDC}" if test >= my_result else f"{FAIL}FAILED{ENDC}"
 
 
+SERVER_START_TIMEOUT = 10  # seconds
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# as written by client.py --stats-file and returned by simulation.simulate()
+METRICS = ['different_lines', 'ecn_packets', 'server_packets', 'rounds', 'additional_packets']
+
 metric_names = [
 	'# different lines in client file --> {} test: {}, me: {}',
 	'# server-triggered ECN packets   --> {} test: {}, me: {}',
@@ -36,33 +43,163 @@ metric_names = [
 	'# server packets after completed --> {} test: {}, me: {}',
 ]
 
-good = 0
-all_logs = ''
-
-for test in tests:
-	print(f"{HEADER}Running test {test[0]}{ENDC} Command: {HEADER}{test[1]}{ENDC}")
-	result = subprocess.run(test[1],
-	                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True,
-	                        text=True).stdout.split('\n')
-
-	all_logs += f'======================================Running test {test[0]}======================================\n'
-	all_logs += '\n'.join(result)
-	all_logs += f'======================================Ending test {test[0]}======================================\n\n\n\n'
-
-	for i in range(0, 5):
-		res = get_result(test[2 + i], int(result[-7 + i].split(' ')[-1]))
-		good += (res == f"{OKGREEN}PASSED{ENDC}")
-		print(metric_names[i].format(res, test[2 + i], result[-7 + i].split(' ')[-1]))
-
-	print(f"# Time taken: {OKBLUE}{' '.join(result[-2].split(' ')[-2:])}{ENDC}")
-
-print(f"{OKBLUE}Passed {good} tests out of {len(tests) * 5}{ENDC}")
-failed = len(tests) * 5 - good
-
-if failed > 0:
-	print(f"{FAIL}Failed {failed} metrics{ENDC}")
-else:
-	print(f"{OKGREEN}Passed all tests!{ENDC}")
 
-with open('full_test_logs.txt', 'w') as f:
-	f.write(all_logs)
\ No newline at end of file
+def run_concurrent_clients(num_clients, first_port):
+	# every client gets its own port and output file, all of them download at the same time
+	out_dir = tempfile.mkdtemp()
+	processes = []
+	for i in range(num_clients):
+		port = first_port + i
+		outfile = os.path.join(out_dir, f"client_file_{port}.txt")
+		command = f"python3 client.py --set-queue-delay=0.1 -p {port} -o {outfile}"
+		processes.append((port, subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+		                                         shell=True, text=True)))
+
+	failed = 0
+	for port, process in processes:
+		result = process.communicate()[0].split('\n')
+		diff_lines = [line for line in result if line.startswith('# different lines in client file')]
+		ok = process.returncode == 0 and len(diff_lines) == 1 and diff_lines[0].split(' ')[-1] == '0'
+		failed += not ok
+		print(f"# client on port {port} --> {OKGREEN + 'PASSED' if ok else FAIL + 'FAILED'}{ENDC}")
+		os.remove(os.path.join(out_dir, f"client_file_{port}.txt"))
+	os.rmdir(out_dir)
+
+	if failed > 0:
+		print(f"{FAIL}{failed} out of {num_clients} concurrent transfers failed{ENDC}")
+	else:
+		print(f"{OKGREEN}All {num_clients} concurrent transfers completed!{ENDC}")
+	return failed
+
+
+def run_random_scenarios(count, seed):
+	# imported here, the subprocess runs do not need the client and server in this process
+	import simulation
+	start = time.time()
+	failed = 0
+	for args, metrics in simulation.random_scenarios(count, seed):
+		if not metrics['finished'] or metrics['different_lines'] > 0 or metrics['additional_packets'] > 0:
+			failed += 1
+			print(f"{FAIL}FAILED{ENDC} {' '.join(args)}: {metrics}")
+	print(f"# Time taken: {OKBLUE}{time.time() - start:.2f} seconds{ENDC}")
+	if failed > 0:
+		print(f"{FAIL}{failed} out of {count} random scenarios failed (seed {seed}){ENDC}")
+	else:
+		print(f"{OKGREEN}All {count} random scenarios completed (seed {seed})!{ENDC}")
+	return failed
+
+
+def start_server(server_args, log, cwd=None):
+	# with -p 0 the system picks a free port, which the server reports in its first line;
+	# the server serves the server_file.txt of `cwd`
+	server = subprocess.Popen([sys.executable, '-u', SERVER_SCRIPT, '-p', '0'] + server_args,
+	                          stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+	deadline = time.time() + SERVER_START_TIMEOUT
+	while True:
+		with open(log.name) as f:
+			line = f.readline()
+		if line.endswith('\n'):
+			return server, int(line.split(' ')[-1])
+		if server.poll() is not None or time.time() > deadline:
+			server.kill()
+			raise RuntimeError(f"server did not start: {line}")
+		time.sleep(0.01)
+
+
+def run_test(test, server_args=(), server_address=None):
+	"""Run one test against its own server on a free port, or against server_address
+	if given. Returns the client's stats and output."""
+	with tempfile.TemporaryDirectory() as work_dir:
+		stats_file = os.path.join(work_dir, 'stats.json')
+		command = [sys.executable] + shlex.split(test[1])[1:] + ['--stats-file', stats_file]
+		server = None
+		if server_address is None:
+			server_log = open(os.path.join(work_dir, 'server.log'), 'w')
+			server, port = start_server(list(server_args), server_log)
+			command += ['-p', '0', '-s', f'127.0.0.1:{port}', '-o', os.path.join(work_dir, 'client_file.txt')]
+		else:
+			command += ['-s', server_address]
+		try:
+			result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+		finally:
+			if server is not None:
+				# terminated rather than killed, so that it can flush a --trace or --metrics-file
+				server.terminate()
+				server.wait()
+				server_log.close()
+		if result.returncode != 0:
+			raise RuntimeError(f"test {test[0]} failed to run:\n{result.stdout}")
+		with open(stats_file) as f:
+			return json.load(f), result.stdout
+
+
+def run_simulated_test(test):
+	import simulation
+	return simulation.simulate(test[1].split()[2:]), None
+
+
+if __name__ == "__main__":
+	parser = OptionParser()
+	parser.add_option("--concurrent-clients", dest="clients", type="int", default=0,
+	                  help="run this many clients against the server at the same time instead of the test suite")
+	parser.add_option("--first-client-port", dest="first_port", type="int", default=40100,
+	                  help="port of the first concurrent client, the others use the following ports (default: 40100)")
+	parser.add_option("--simulate", dest="simulate", action="store_true", default=False,
+	                  help="run the clients and the server in this process, on a virtual clock (see simulation.py)")
+	parser.add_option("--random-scenarios", dest="random_scenarios", type="int", default=0,
+	                  help="simulate this many random loss and buffer scenarios instead of the test suite")
+	parser.add_option("--seed", dest="seed", type="int", default=0,
+	                  help="seed of the random scenarios, the same seed runs the same scenarios (default: 0)")
+	parser.add_option("--jobs", dest="jobs", type="int", default=len(tests),
+	                  help="number of tests to run at the same time, each with its own server (default: {})".format(
+		                  len(tests)))
+	parser.add_option("--server-args", dest="server_args", type="string", default="",
+	                  help="options for the servers the tests start, e.g. \"--engine=asyncio\"")
+	parser.add_option("--server", dest="server_address", type="string", default=None, metavar="IP:PORT",
+	                  help="run the tests one at a time against an already running server instead")
+	(options, args) = parser.parse_args()
+
+	if options.clients > 0:
+		sys.exit(1 if run_concurrent_clients(options.clients, options.first_port) > 0 else 0)
+	if options.random_scenarios > 0:
+		sys.exit(1 if run_random_scenarios(options.random_scenarios, options.seed) > 0 else 0)
+	if options.simulate:
+		# in-process and sharing stdout, so one test at a time
+		(jobs, run) = (1, run_simulated_test)
+	elif options.server_address:
+		(jobs, run) = (1, lambda test: run_test(test, server_address=options.server_address))
+	else:
+		(jobs, run) = (options.jobs, lambda test: run_test(test, shlex.split(options.server_args)))
+
+	good = 0
+	all_logs = ''
+	start = time.time()
+
+	# the tests mostly wait for timers and queuing cycles, threads are enough to overlap them
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+		for test, (metrics, output) in zip(tests, executor.map(run, tests)):
+			print(f"{HEADER}Running test {test[0]}{ENDC} Command: {HEADER}{test[1]}{ENDC}")
+			if output is not None:
+				all_logs += f'======================================Running test {test[0]}======================================\n'
+				all_logs += output
+				all_logs += f'======================================Ending test {test[0]}======================================\n\n\n\n'
+
+			for i in range(0, 5):
+				res = get_result(test[2 + i], metrics[METRICS[i]])
+				good += (res == f"{OKGREEN}PASSED{ENDC}")
+				print(metric_names[i].format(res, test[2 + i], metrics[METRICS[i]]))
+
+			print(f"# Time taken: {OKBLUE}{metrics['time']}{' simulated' if options.simulate else ''} seconds{ENDC}")
+
+	print(f"# Total time: {OKBLUE}{time.time() - start:.2f} seconds{ENDC}")
+	print(f"{OKBLUE}Passed {good} tests out of {len(tests) * 5}{ENDC}")
+	failed = len(tests) * 5 - good
+
+	if failed > 0:
+		print(f"{FAIL}Failed {failed} metrics{ENDC}")
+	else:
+		print(f"{OKGREEN}Passed all tests!{ENDC}")
+
+	if not options.simulate:  # the simulation keeps no logs
+		with open('full_test_logs.txt', 'w') as f:
+			f.write(all_logs)
\ No newline at end of file
@@ -1,23 +1,52 @@
 #! /usr/bin/python3
 
-import sys, socket, hashlib, threading, time
+import sys, os, signal, socket, hashlib, zlib, threading, time, heapq, itertools, asyncio, contextlib, mmap, struct, functools, io
+import logging, logging.handlers, queue, atexit, bisect
+from array import array
 from optparse import OptionParser, OptionValueError
+from congestion import CONGESTION_CONTROLLERS
+from recovery import LossRecovery
+from metrics import ConnectionMetrics, ServerMetrics
+from tracing import Tracer, NULL_TRACER
+from integrity import INTEGRITY_CHECKS, DEFAULT_INTEGRITY
+from pathcache import PathCache, default_path_cache_ttl, default_path_cache_prefix
 
 # default parameters
 default_ip = '127.0.0.1'
 default_port = 50023
-INITIAL_SSTHRESH = 8
-INITIAL_CWND = 1
-INITIAL_TIMEOUT = 5
+default_engine = "threads"
+default_congestion_control = "default"
+default_workers = 1
+default_log_level = "warning"
+default_metrics_interval = 1  # seconds
+default_idle_timeout = 30  # seconds without a datagram from a client before its connection is dropped
+CLOSED_QUIET_TIME = 1  # seconds to ignore a closed client after answering it, without an RTT (RFC 6298's initial RTO)
+CONTENT_FILENAME = "server_file.txt"
 
-NEW_RTT_WEIGHT = 0.1
-NEW_DEVIATION_WEIGHT = 0.125
-DEVIATIONS_IN_TIMEOUT = 6
+MAIN_THREAD_SLEEP_TIME = 0.000001
 
-ACKS_ON_MAX_WINDOW_THRESHOLD = 3
+MAX_RECEIVE_BATCH = 64
+RECEIVE_NONBLOCKING = getattr(socket, "MSG_DONTWAIT", 0)  # not available on every platform
 
-TIMEOUT_INCREMENT = 0.0001
-MAIN_THREAD_SLEEP_TIME = 0.000001
+INDEX_SUFFIX = ".idx"
+PACKET_CACHE_SIZE = 4096
+
+MAX_DATAGRAM_SIZE = 512  # clients read with recvfrom(512)
+MAX_CLIENT_ID_SIZE = len("[255.255.255.255:65535] ")
+ECN_PREAMBLE_SIZE = len("ECN dropped ")  # echoed back to us in front of the packet
+CHECKSUM_SIZE = 32  # MD5 in hex, the longest integrity check
+COMPRESSION_LEVEL = 9  # the segments are compressed once per file, so the best ratio is worth its time
+# a segment is a few KB at most: a small window and state make the copies taken to flush a candidate cheap
+SEGMENT_WINDOW_BITS = 12
+SEGMENT_MEMORY_LEVEL = 5
+ZLIB_OVERHEAD = 11  # zlib header and checksum, and the header of a stored block
+
+FAST_RETRANSMIT_DUPLICATES = 2  # duplicates on top of the original ACK
+# paced windows go out this much faster than one window per smoothed RTT, as in Linux: in slow start the
+# window doubles every RTT, and a rate of exactly cwnd / RTT would leave the last packets for the next round
+PACING_GAIN_SLOW_START = 2
+PACING_GAIN_AVOIDANCE = 1.2
+INITIAL_WINDOW_SLOTS = 64
 
 ####################
 # Helper functions #
@@ -25,14 +54,49 @@ MAIN_THREAD_SLEEP_TIME = 0.000001
 
 global_lock = threading.RLock()
 
+logger = logging.getLogger("server")
+
+
+def setup_logging(level):
+	# records are formatted and written by a listener thread, the protocol only queues them
+	records = queue.SimpleQueue()
+	handler = logging.StreamHandler(sys.stdout)
+	handler.setFormatter(logging.Formatter("%(message)s"))
+	listener = logging.handlers.QueueListener(records, handler)
+	listener.start()
+	atexit.register(listener.stop)  # writes out what is still queued
+	logger.addHandler(logging.handlers.QueueHandler(records))
+	logger.setLevel(level.upper())
+	return listener
+
 
-def get_checksum(msg):
-	return hashlib.md5(msg.encode()).hexdigest()
+def get_sack_ranges(req):
+	# "ACK 4 SACK 6-8,10-10" -> [(6, 8), (10, 10)]
+	words = req.split(" ")
+	if len(words) < 4 or words[2] != "SACK":
+		return []
+	ranges = []
+	for block in words[3].split(","):
+		first, dash, last = block.partition("-")
+		if dash and first.isdigit() and last.isdigit():  # a malformed block says nothing, drop it
+			ranges.append((int(first), int(last)))
+	return ranges
+
+
+def get_line_range(options, lines):
+	# "GET 100-199" -> (100, 200), "GET 100" -> (100, lines), a bare GET -> (0, lines)
+	for option in options:
+		if option[:1].isdigit():
+			start, _, end = option.partition("-")
+			start = min(int(start), lines)
+			end = lines if not end else min(int(end) + 1, lines)
+			return (start, max(start, end))
+	return (0, lines)
 
 
 def check_port(option, opt_str, value, parser):
-	if value < 32768 or value > 61000:
-		raise OptionValueError("need 32768 <= port <= 61000")
+	if value != 0 and (value < 32768 or value > 61000):  # 0 lets the system pick a free port
+		raise OptionValueError("need 32768 <= port <= 61000, or 0")
 	parser.values.port = value
 
 
@@ -48,239 +112,1193 @@ def check_address(option, opt_str, value, parser):
 
 
 def get_client_address(data):
-	decoded = data.decode()
+	# latin-1 never fails: an ECN packet bounced back may carry a compressed, binary segment
+	decoded = data.decode("latin-1")
 	if decoded[:3] == "ECN":
 		return "[" + decoded.split("]")[0].split("[")[1] + "]"
 	else:
 		return decoded.split("]")[0] + "]"
 
 
-class Server:
-	def __init__(self, own_address):
-		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.sock.bind(own_address)
-		self.content = []
-		self.client_address = None
-		self.sender_address = None
-		self.transfer_in_progress = None
-		self.last_ack = None
-		self.duplicated_acks = None
-		self.timers = None
-		self.timer_updated = None
-		self.timer_in_flight = None
-		self.time_sent = None
-		self.rtt = None
-		self.deviation = None
-		self.timeout_s = None
-		self.ssthresh = None
-		self.cwnd = None
-		self.last_sent = None
-		self.acks_received = None
-		self.acks_on_max_window = None
-
-		self.reset_variables()
-
-	def reset_variables(self):
-		self.client_address = None
-		self.sender_address = None
+class FileContent:
+	"""Lines of the served file, sliced straight out of a memory map.
+
+	The start offset and MD5 digest of every line are kept in a sidecar index
+	(<filename>.idx) that is built on first use and reused while the file is
+	unchanged, so startup and memory use do not grow with the file size.
+	"""
+	HEADER = struct.Struct("<8sQQQ")  # magic, file size, file mtime (ns), number of lines
+	RECORD = struct.Struct("<Q16s")  # line start offset, MD5 digest of the line
+	MAGIC = b"RUDPIDX1"
+
+	def __init__(self, filename):
+		self.file = open(filename, "rb")
+		stat = os.fstat(self.file.fileno())
+		self.size = stat.st_size
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+		self.index = self.load_index(filename + INDEX_SUFFIX, stat)
+		if self.index is None:
+			self.index = self.build_index(filename + INDEX_SUFFIX, stat)
+		self.lines = self.HEADER.unpack_from(self.index)[3]
+		self.segmented = None
+		self.compressed = None
+		self.checksummed = {}  # integrity check -> ChecksummedContent
+		# retransmissions and concurrent clients mostly hit the same few packets
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def __len__(self):
+		return self.lines
+
+	def load_index(self, index_filename, stat):
+		try:
+			with open(index_filename, "rb") as f:
+				index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+		if len(index) < self.HEADER.size:
+			return None
+		magic, size, mtime, lines = self.HEADER.unpack_from(index)
+		if magic != self.MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns or \
+			len(index) != self.HEADER.size + lines * self.RECORD.size:
+			return None
+		return index
+
+	def build_index(self, index_filename, stat):
+		tmp_filename = "{}.{}".format(index_filename, os.getpid())
+		try:
+			with open(tmp_filename, "wb") as f:
+				self.write_index(f, stat)
+			os.replace(tmp_filename, index_filename)
+			return self.load_index(index_filename, stat)
+		except OSError:  # read-only directory, keep the index in memory
+			records = io.BytesIO()
+			self.write_index(records, stat)
+			return records.getbuffer()
+
+	def write_index(self, f, stat):
+		f.write(bytes(self.HEADER.size))
+		lines = 0
+		start = 0
+		while start < self.size:
+			end = self.data.find(b"\n", start)
+			end = self.size if end == -1 else end + 1
+			f.write(self.RECORD.pack(start, hashlib.md5(self.data[start:end]).digest()))
+			lines += 1
+			start = end
+		f.seek(0)
+		f.write(self.HEADER.pack(self.MAGIC, stat.st_size, stat.st_mtime_ns, lines))
+
+	def line_bounds(self, index):
+		start, digest = self.RECORD.unpack_from(self.index, self.HEADER.size + index * self.RECORD.size)
+		if index + 1 < self.lines:
+			end = self.RECORD.unpack_from(self.index, self.HEADER.size + (index + 1) * self.RECORD.size)[0]
+		else:
+			end = self.size
+		return start, end, digest
+
+	def payload(self, index):
+		start, end, _ = self.line_bounds(index)
+		return self.data[start:end]
+
+	def encode_packet(self, index):
+		# everything after the client id, with the MD5 digest from the index
+		start, end, digest = self.line_bounds(index)
+		return b" %d:%b|%b" % (index, self.data[start:end], digest.hex().encode())
+
+	def segments(self):
+		# built on the first transfer that asks for multi-line segments, then shared
+		if self.segmented is None:
+			self.segmented = SegmentedContent(self)
+		return self.segmented
+
+	def compressed_segments(self):
+		# like the segments, compressed on the first transfer that asks for it
+		if self.compressed is None:
+			self.compressed = CompressedContent(self)
+		return self.compressed
+
+
+class SegmentedContent:
+	"""The lines of a FileContent packed into segments that fill a datagram.
+
+	Each sequence number covers a run of consecutive lines; a line too long to
+	share a datagram gets a segment of its own.
+	"""
+
+	def __init__(self, content):
+		self.content = content
+		overhead = MAX_CLIENT_ID_SIZE + ECN_PREAMBLE_SIZE + len(" {}:|".format(len(content))) + CHECKSUM_SIZE
+		self.payload_limit = MAX_DATAGRAM_SIZE - overhead
+		self.starts = array("Q")  # first line of every segment
+		size = 0
+		for index in range(len(content)):
+			start, end, _ = content.line_bounds(index)
+			if not self.starts or size + end - start > self.payload_limit:
+				self.starts.append(index)
+				size = 0
+			size += end - start
+		self.checksummed = {}
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def payload(self, index):
+		first = self.starts[index]
+		last = self.starts[index + 1] - 1 if index + 1 < len(self.starts) else len(self.content) - 1
+		start = self.content.line_bounds(first)[0]
+		end = self.content.line_bounds(last)[1]
+		return self.content.data[start:end]
+
+	def encode_packet(self, index):
+		payload = self.payload(index)
+		return b" %d:%b|%b" % (index, payload, INTEGRITY_CHECKS[DEFAULT_INTEGRITY](payload))
+
+
+def compress_segment(content, first, end, payload_limit, trust_growth=True):
+	# as many lines from `first` on as fit `payload_limit` once compressed: (zlib stream, line after the last)
+	compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, SEGMENT_WINDOW_BITS, SEGMENT_MEMORY_LEVEL)
+	output = []
+	fed = content.line_bounds(first)[0]  # the lines before are in the compressor, the lines from here are not yet
+	block = None  # the stream of the lines fed so far, if they were checked
+	checked = 0  # its size when it was last checked
+	unchecked = 0  # bytes of the lines since
+	for index in range(first, end):
+		start, line_end, _ = content.line_bounds(index)
+		if index == first or checked + unchecked + line_end - start + ZLIB_OVERHEAD <= payload_limit:
+			# from the start of a stream, lines never compress to more than their size and a stored block;
+			# after a check, with `trust_growth`, they are assumed not to grow it by more either
+			unchecked += line_end - start
+			block = None
+			continue
+		# the line may not fit: try it on a flushed copy, keeping the state before it
+		output.append(compressor.compress(content.data[fed:start]))
+		before = (compressor.copy(), len(output)) if block is None else None
+		output.append(compressor.compress(content.data[start:line_end]))
+		fed = line_end
+		candidate = b"".join(output) + compressor.copy().flush()
+		if len(candidate) <= payload_limit:
+			checked = len(candidate) if trust_growth else checked + unchecked + line_end - start
+			unchecked = 0
+			block = candidate
+			continue
+		if block is None:
+			block = b"".join(output[:before[1]]) + before[0].flush()
+			if len(block) > payload_limit and index > first + 1:
+				return None  # the lines since the last check grew the stream by more than their size: look at every line
+		return block, index
+	if block is None:
+		output.append(compressor.compress(content.data[fed:content.line_bounds(end - 1)[1]]))
+		block = b"".join(output) + compressor.flush()
+	return block, end
+
+
+def compress_lines(content, start, end, payload_limit):
+	"""Lines [start, end) of `content` as zlib streams of as many lines as fit `payload_limit` bytes.
+
+	Returns the first line of every stream and the streams. Each line goes once
+	through the compressor of its segment, which is flushed on a copy to see
+	whether a line still fits only once the lines fed since the last look could
+	have filled what was left. A line too long to share a datagram gets a stream
+	of its own.
+	"""
+	starts = array("Q")
+	blocks = []
+	while start < end:
+		block, next_start = compress_segment(content, start, end, payload_limit) or \
+			compress_segment(content, start, end, payload_limit, trust_growth=False)
+		starts.append(start)
+		blocks.append(block)
+		start = next_start
+	return starts, blocks
+
+
+class CompressedContent(SegmentedContent):
+	"""Segments of consecutive lines as zlib streams, each as many lines as fit a datagram once compressed.
+
+	Every segment is compressed on its own, so it decodes without the others
+	and a lost one is just retransmitted. The table is built once per file, on
+	the first transfer that asks for it, and line ranges reuse its segments.
+	The checksum covers the compressed bytes.
+	"""
+
+	def __init__(self, content):
+		self.content = content
+		overhead = MAX_CLIENT_ID_SIZE + ECN_PREAMBLE_SIZE + len(" {}:|".format(len(content))) + CHECKSUM_SIZE
+		self.payload_limit = MAX_DATAGRAM_SIZE - overhead
+		self.starts, self.blocks = compress_lines(content, 0, len(content), self.payload_limit)
+		self.checksummed = {}
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def payload(self, index):
+		return self.blocks[index]
+
+
+class CompressedRange(SegmentedContent):
+	"""The compressed segments of lines [start, end) of a file, numbered from 0.
+
+	The segments of the file that lie wholly inside the range are shared with
+	its CompressedContent; only the lines before the first and after the last
+	of them are compressed for the range.
+	"""
+
+	def __init__(self, compressed, start, end):
+		self.payload_limit = compressed.payload_limit
+		starts = compressed.starts
+		first = bisect.bisect_left(starts, start)
+		last = len(starts) if end >= len(compressed.content) else bisect.bisect_right(starts, end) - 1
+		if last <= first:
+			self.blocks = compress_lines(compressed.content, start, end, self.payload_limit)[1]
+		else:
+			self.blocks = compress_lines(compressed.content, start, starts[first], self.payload_limit)[1]
+			self.blocks += compressed.blocks[first:last]
+			if last < len(starts):
+				self.blocks += compress_lines(compressed.content, starts[last], end, self.payload_limit)[1]
+		self.checksummed = {}
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def __len__(self):
+		return len(self.blocks)
+
+	payload = CompressedContent.payload
+
+
+class ContentRange:
+	"""Lines [start, end) of a FileContent, numbered from 0 as if they were a file of their own.
+
+	Serves GETs for a range of lines, e.g. a client resuming an interrupted
+	download, without the connection having to know about it.
+	"""
+
+	def __init__(self, content, start, end):
+		self.content = content
+		self.start = start
+		self.end = end
+		self.data = content.data
+		self.segmented = None
+		self.compressed = None
+		self.checksummed = {}
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def __len__(self):
+		return self.end - self.start
+
+	def line_bounds(self, index):
+		return self.content.line_bounds(self.start + index)
+
+	# same packets and segments as the whole file, with the sequence numbers of the range
+	payload = FileContent.payload
+	encode_packet = FileContent.encode_packet
+	segments = FileContent.segments
+
+	def compressed_segments(self):
+		# cut out of the file's compressed segments rather than compressed again for every range
+		if self.compressed is None:
+			self.compressed = CompressedRange(self.content.compressed_segments(), self.start, self.end)
+		return self.compressed
+
+
+class ChecksummedContent:
+	"""The packets of a FileContent, SegmentedContent or ContentRange with another
+	integrity check than MD5, for the clients that ask for one in their GET."""
+
+	def __init__(self, content, algorithm):
+		self.content = content
+		self.checksum = INTEGRITY_CHECKS[algorithm]
+		self.packet = functools.lru_cache(maxsize=PACKET_CACHE_SIZE)(self.encode_packet)
+
+	def __len__(self):
+		return len(self.content)
+
+	def encode_packet(self, index):
+		payload = self.content.payload(index)
+		return b" %d:%b|%b" % (index, payload, self.checksum(payload))
+
+
+def with_integrity(content, algorithm):
+	# built once per content and check, then shared by the connections like the segments
+	if algorithm == DEFAULT_INTEGRITY:
+		return content
+	if algorithm not in content.checksummed:
+		content.checksummed[algorithm] = ChecksummedContent(content, algorithm)
+	return content.checksummed[algorithm]
+
+
+class TimerHandle:
+	__slots__ = ("deadline", "callback", "args", "cancelled")
+
+	def __init__(self, deadline, callback, args):
+		self.deadline = deadline
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+
+class TimerScheduler:
+	"""Runs all retransmission timers from one thread, ordered in a min-heap.
+
+	Arming a timer is O(log n); cancelling only marks the handle, and cancelled
+	entries are dropped when they reach the top of the heap. Callbacks run while
+	holding `lock`, and a handle cancelled under that lock never fires. A callback
+	that raises is logged, and the other timers keep firing.
+	"""
+
+	def __init__(self, lock):
+		self.lock = lock
+		self.heap = []
+		self.counter = itertools.count()  # keeps timers with equal deadlines in arming order
+		self.condition = threading.Condition(threading.Lock())
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def call_later(self, delay, callback, *args):
+		handle = TimerHandle(time.monotonic() + delay, callback, args)
+		with self.condition:
+			heapq.heappush(self.heap, (handle.deadline, next(self.counter), handle))
+			if self.heap[0][2] is handle:  # new earliest deadline, wake the timer thread up
+				self.condition.notify()
+		return handle
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.heap or self.heap[0][0] > time.monotonic():
+					self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+				handle = heapq.heappop(self.heap)[2]
+			if handle.cancelled:
+				continue
+			with self.lock:
+				if not handle.cancelled:
+					try:
+						handle.callback(*handle.args)
+					except Exception:  # the thread runs every connection's timers, one failing must not stop them
+						logger.exception("Timer callback %r failed", handle.callback)
+
+
+class EventLoopScheduler:
+	"""Same interface as TimerScheduler, backed by the asyncio event loop's timers."""
+
+	def __init__(self, loop):
+		self.loop = loop
+
+	def call_later(self, delay, callback, *args):
+		return self.loop.call_at(self.loop.time() + delay, callback, *args)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+	def __init__(self, server):
+		self.server = server
+
+	def connection_made(self, transport):
+		self.server.send_datagram = transport.sendto
+
+	def datagram_received(self, data, addr):
+		# datagrams read in the same loop iteration share one flush of the replies
+		if self.server.outbox is None:
+			self.server.outbox = []
+			self.server.loop.call_soon(self.server.flush_outbox)
+		self.server.handle_datagram(data, addr)
+
+
+class SendWindow:
+	"""Send state of the packets in flight, in ring buffer slots indexed by sequence number.
+
+	The slots cover sequence numbers from `base`, the first packet not yet
+	cumulatively acknowledged, and the ring doubles when the window outgrows it.
+	An ACK only clears the slots it moves past, so it costs O(packets acknowledged)
+	and memory follows the size of the window rather than the size of the file.
+	"""
+
+	def __init__(self, capacity=INITIAL_WINDOW_SLOTS):
+		self.base = 0
+		self.sacked_count = 0
+		self.highest = -1  # highest selectively acknowledged packet, below `base` when there is none
+		self.allocate(capacity)
+
+	def allocate(self, capacity):
+		self.capacity = capacity
+		self.time_sent = array("d", [0.0]) * capacity  # 0 for slots not sent yet
+		self.retransmits = array("I", [0]) * capacity
+		self.sacked = bytearray(capacity)
+		self.timers = [None] * capacity
+
+	def slot(self, index):
+		if index - self.base >= self.capacity:
+			self.grow(index - self.base + 1)
+		return index % self.capacity
+
+	def grow(self, needed):
+		old_capacity, time_sent, retransmits, sacked, timers = \
+			self.capacity, self.time_sent, self.retransmits, self.sacked, self.timers
+		capacity = old_capacity
+		while capacity < needed:
+			capacity *= 2
+		self.allocate(capacity)
+		for index in range(self.base, self.base + old_capacity):
+			old, new = index % old_capacity, index % capacity
+			self.time_sent[new] = time_sent[old]
+			self.retransmits[new] = retransmits[old]
+			self.sacked[new] = sacked[old]
+			self.timers[new] = timers[old]
+
+	def record_send(self, index, now):
+		if index < self.base:  # already acknowledged, nothing to track
+			return
+		slot = self.slot(index)
+		if self.time_sent[slot]:
+			self.retransmits[slot] += 1
+		self.time_sent[slot] = now
+
+	def sent_at(self, index):
+		if not 0 <= index - self.base < self.capacity:
+			return None
+		return self.time_sent[index % self.capacity] or None
+
+	def retransmitted(self, index):
+		return 0 <= index - self.base < self.capacity and self.retransmits[index % self.capacity] > 0
+
+	def set_timer(self, index, timer):
+		slot = self.slot(index)
+		if self.timers[slot] is not None:
+			self.timers[slot].cancel()
+		self.timers[slot] = timer
+
+	def mark_sacked(self, index):
+		if index < self.base:
+			return
+		slot = self.slot(index)
+		if not self.sacked[slot]:
+			self.sacked[slot] = 1
+			self.sacked_count += 1
+			self.highest = max(self.highest, index)
+			if self.timers[slot] is not None:  # received, will never need a retransmission
+				self.timers[slot].cancel()
+				self.timers[slot] = None
+
+	def is_sacked(self, index):
+		return 0 <= index - self.base < self.capacity and self.sacked[index % self.capacity]
+
+	def highest_sacked(self):
+		return self.highest if self.highest >= self.base else None
+
+	def advance(self, new_ack):
+		for index in range(self.base, new_ack + 1):
+			slot = index % self.capacity
+			if self.timers[slot] is not None:
+				self.timers[slot].cancel()
+				self.timers[slot] = None
+			self.sacked_count -= self.sacked[slot]
+			self.sacked[slot] = 0
+			self.time_sent[slot] = 0.0
+			self.retransmits[slot] = 0
+		self.base = max(self.base, new_ack + 1)
+		if self.highest < self.base:
+			self.highest = -1
+
+	def clear(self):
+		for timer in self.timers:
+			if timer is not None:
+				timer.cancel()
+		self.allocate(self.capacity)
+		self.sacked_count = 0
+		self.highest = -1
+
+
+class ClosedClient:
+	"""What the server keeps of a finished transfer, to finish the closing handshake with a client that missed it."""
+	__slots__ = ("answered_at", "sender_address", "quiet_time", "fin_repeated")
+
+	def __init__(self, answered_at, sender_address, quiet_time, fin_repeated=False):
+		self.answered_at = answered_at  # when the transfer ended or the handshake was last repeated
+		self.sender_address = sender_address
+		self.quiet_time = quiet_time  # datagrams that crossed the last answer arrive within it
+		self.fin_repeated = fin_repeated  # whether the last answer was the FIN, so the ACK FIN is a new one
+
+
+class Connection:
+	"""Transfer state for a single client, keyed by its [ip:port] id."""
+
+	def __init__(self, server, client_address, sender_address, options=()):
+		self.server = server
+		self.options = tuple(options)  # a GET with other options from the same client starts a new connection
+		# what a sequence number refers to: a single line, or a segment of lines, plain or compressed, of the file
+		# or of the range asked for
+		(start, end) = get_line_range(options, len(server.content))
+		self.lines = end - start  # lines of the file to send, however many packets they take
+		content = server.content if end - start == len(server.content) else ContentRange(server.content, start, end)
+		if "deflate" in options:
+			content = content.compressed_segments()
+		elif "segments" in options:
+			content = content.segments()
+		# MD5 unless the client asks for a cheaper check; clients that do not know about it get MD5 too
+		self.content = with_integrity(content, next((option for option in options if option in INTEGRITY_CHECKS),
+		                                            DEFAULT_INTEGRITY))
+		# with selective ACKs only the holes are retransmitted, instead of everything after them
+		self.sack = "sack" in options
+		self.client_id = client_address.encode()
+		self.client_address = client_address
+		self.sender_address = sender_address
 		self.transfer_in_progress = False
 
 		self.last_ack = -1
 		self.duplicated_acks = 0
-		self.timers = {}
-		self.timer_updated = {}
+		self.window = SendWindow()  # send time, timer and SACK state of the packets in flight
 		self.timer_in_flight = 0  # messages in flight triggered by timer before any ACK
 
-		# RTT, Deviation, timeout
-		self.time_sent = {}
-		self.rtt = None
-		self.deviation = TIMEOUT_INCREMENT
-		self.timeout_s = INITIAL_TIMEOUT
+		# RTT, timeout and time-based loss detection
+		self.recovery = LossRecovery()
+		self.loss_timer = None  # reordering timer or tail loss probe, whichever is due
+		self.loss_deadline = None  # when a packet the client is missing counts as lost
+		self.delivered_sent_at = None  # send time of the newest packet delivered past the cumulative ACK
+		self.probe_sent = False
+		self.close_on_last_ack = False  # the FIN went out again after an ECN mark, see process_ecn
 
-		self.ssthresh = INITIAL_SSTHRESH
-		self.cwnd = INITIAL_CWND
+		self.cc = CONGESTION_CONTROLLERS[server.congestion_control](server.clock)
 		self.last_sent = -1
-		self.acks_received = 0
-		self.acks_on_max_window = 0
+		self.highest_sent = -1  # last_sent goes back on go-back-N retransmissions, this does not
+		self.loss_cause = None  # what made the server resend packets lately, for the metrics
+		self.metrics = ConnectionMetrics()
+		self.trace = server.tracer.event
+		self.traced_window = None  # (cwnd, ssthresh) in the last cwnd event
+		self.window_base = -1  # ACK the congestion window is counted from
+		self.pacing_timer = None
+		# a client that goes away mid-transfer would otherwise keep its entry and its timers forever
+		self.last_heard = server.clock()
+		self.idle_timer = server.scheduler.call_later(server.idle_timeout, self.check_idle)
 
-	def read_content(self, filename):
-		with open(filename) as f:
-			self.content = f.readlines()
-
-	def remove_timers(self, new_ack):
-		for i in range(0, new_ack + 1):
-			if i in self.timers:
-				self.timers[i].cancel()
-				del self.timers[i]
-			if i in self.timer_updated:
-				del self.timer_updated[i]
+		path = server.path_cache.get(sender_address[0]) if server.path_cache is not None else None
+		if path is not None:  # a client seen lately, skip the initial RTO and most of slow start
+			self.recovery.seed(path.rtt, path.deviation)
+			self.cc.seed(path.cwnd, path.ssthresh)
+			self.trace("seed", client=client_address, cwnd=path.cwnd, ssthresh=path.ssthresh, rtt=path.rtt)
 
 	def update_timeout(self, new_ack):
-		rtt_sample = time.time() - self.time_sent[new_ack]
-		self.rtt = NEW_RTT_WEIGHT * rtt_sample + (1 - NEW_RTT_WEIGHT) * self.rtt if self.rtt else rtt_sample
+		time_sent = self.window.sent_at(new_ack)
+		if time_sent is None:  # ACK for a packet that is no longer tracked
+			return None
+		# Karn's algorithm: the ACK may belong to any copy of a retransmitted packet, and one for
+		# a packet already selectively acknowledged was triggered by another packet
+		if self.window.retransmitted(new_ack) or self.window.is_sacked(new_ack):
+			return None
+		rtt_sample = self.server.clock() - time_sent
+		self.recovery.on_rtt_sample(rtt_sample)
+		self.metrics.rtt.observe(rtt_sample)
+		return rtt_sample
+
+	def update_sacked(self, new_ack, sack_ranges):
+		for (first, last) in sack_ranges:
+			for index in range(max(first, new_ack + 1), min(last, self.last_sent) + 1):
+				self.window.mark_sacked(index)
 
-		deviation_sample = abs(rtt_sample - self.rtt)
-		self.deviation = NEW_DEVIATION_WEIGHT * deviation_sample + (1 - NEW_DEVIATION_WEIGHT) * self.deviation if self.deviation else deviation_sample
+	def retransmit_holes(self, new_ack):
+		# resend what the client is missing below the highest selectively acknowledged packet
+		highest = self.window.highest_sacked()
+		for index in range(new_ack + 1, (new_ack + 1 if highest is None else highest) + 1):
+			if not self.window.is_sacked(index):
+				self.transmit_line(index)
 
-		self.timeout_s = self.rtt + DEVIATIONS_IN_TIMEOUT * self.deviation
+	def recently_retransmitted(self, index):
+		# the copy is still in flight, so duplicate ACKs arriving now were triggered by older packets
+		time_sent = self.window.sent_at(index)
+		return self.window.retransmitted(index) and self.recovery.rtt is not None and \
+			self.server.clock() - time_sent < self.recovery.rtt / 2
 
-	def process_ack(self, new_ack):
+	def fast_retransmit(self, new_ack):
+		# no window check
+		with self.server.lock:
+			if self.sack:
+				self.retransmit_holes(new_ack)
+			else:
+				self.last_sent = new_ack
+				self.last_ack = new_ack - 1
+			self.cc.on_fast_retransmit()
+			self.duplicated_acks = 0
+			self.loss_deadline = None
+			self.send_window(new_ack)
+
+	def process_ack(self, new_ack, sack_ranges=()):
 		if not self.transfer_in_progress:
 			return
+		# an ACK for a packet never sent is corrupt or forged, and would move the window past unsent data;
+		# the bound is the highest packet ever sent, since going back lowers last_sent below packets in flight
+		if new_ack > self.highest_sent:
+			logger.warning("Ignoring ACK %d from %s, beyond the last packet sent", new_ack, self.client_address)
+			return
 
 		self.timer_in_flight = 0
-		self.acks_received += 1
+		self.metrics.acks += 1
+		if self.sack:
+			self.update_sacked(new_ack, sack_ranges)
 		if new_ack == self.last_ack:
+			self.trace("dupack", client=self.client_address, ack=new_ack)
+			self.metrics.duplicate_acks += 1
+			self.cc.on_dup_ack()
 			self.duplicated_acks += 1
-			if self.duplicated_acks == 2:
-				# fast retransmit, no window check
-				# from csw, doesn't imply congestion
-				self.last_sent = new_ack
-				self.last_ack = new_ack - 1
-				self.acks_received = 0
+			if self.duplicated_acks == FAST_RETRANSMIT_DUPLICATES:
 				self.duplicated_acks = 0
-				print("3 duplicates -> Fast retransmit")
-				while self.transfer_in_progress and self.last_sent + 1 <= len(self.content) and new_ack + self.cwnd > self.last_sent:
-					self.send_line(self.last_sent + 1)
+				if not self.recently_retransmitted(new_ack + 1):
+					logger.debug("3 duplicates -> Fast retransmit")
+					self.loss_cause = "dup_ack"
+					self.fast_retransmit(new_ack)
+				self.arm_loss_timer()
+			else:
+				# a packet after the hole was delivered, sent at least an RTT ago
+				if not self.sack and self.recovery.min_rtt is not None:
+					self.delivered_sent_at = self.server.clock() - self.recovery.min_rtt
+				self.detect_losses()
 			return
 		else:
 			self.duplicated_acks = 0
+		self.trace("ack", client=self.client_address, ack=new_ack)
 
-		self.update_timeout(new_ack)
+		rtt_sample = self.update_timeout(new_ack)
 
-		self.remove_timers(new_ack)
+		self.window.advance(new_ack)
+		self.loss_deadline = None
+		self.probe_sent = False
+		if not self.sack:  # the duplicate ACKs were about packets this ACK covers
+			self.delivered_sent_at = None
 
+		acked = max(new_ack - self.last_ack, 1)
 		self.last_ack = max(new_ack, self.last_ack)
 
-		if self.acks_received >= self.cwnd:
-			if self.cwnd < self.ssthresh:
-				self.cwnd += 1
-				self.acks_received = 0
+		self.cc.on_ack(acked, rtt_sample)
+		self.trace_window()
+
+		if self.close_on_last_ack and self.window.base >= len(self.content):
+			self.end_transfer()
+			return
+		self.send_window(new_ack)
+		if self.sack:
+			self.detect_losses()
+		else:
+			self.arm_loss_timer()
+
+	def process_fin_ack(self):
+		if self.window.base >= len(self.content):  # every line is acknowledged
+			self.end_transfer()
+		else:  # the FIN overtook a lost packet, which makes this a duplicate ACK
+			self.process_ack(self.last_ack)
+
+	def detect_losses(self):
+		# RACK: a packet is lost once a packet sent after it was delivered and it has been
+		# outstanding for longer than the RTT plus the reordering window
+		self.loss_deadline = None
+		if self.sack:
+			highest = self.window.highest_sacked()
+			if highest is not None:
+				self.delivered_sent_at = self.window.sent_at(highest)
+			candidates = range(self.window.base, self.last_sent + 1 if highest is None else highest)
+		else:
+			candidates = (self.window.base,)  # without SACK only the oldest packet is known to be missing
+		if self.delivered_sent_at is None or self.recovery.rtt is None:
+			self.arm_loss_timer()
+			return
+
+		now = self.server.clock()
+		lost = []
+		for index in candidates:
+			time_sent = self.window.sent_at(index)
+			if time_sent is None or time_sent > self.delivered_sent_at or self.window.is_sacked(index):
+				continue
+			deadline = self.recovery.loss_deadline(time_sent)
+			if deadline <= now:
+				lost.append(index)
+			elif self.loss_deadline is None or deadline < self.loss_deadline:
+				self.loss_deadline = deadline
+
+		if lost:
+			logger.debug("Lost packet detected -> retransmit")
+			self.loss_cause = "rack"
+			if self.sack:
+				with self.server.lock:
+					for index in lost:
+						self.transmit_line(index)
+				self.cc.on_fast_retransmit()
 			else:
-				self.acks_on_max_window += 1
-				if self.acks_on_max_window >= ACKS_ON_MAX_WINDOW_THRESHOLD:
-					self.ssthresh += 1
-					self.cwnd = self.ssthresh
-					self.acks_received = 0
-					self.acks_on_max_window = 0
+				self.fast_retransmit(self.window.base - 1)
+		self.arm_loss_timer()
 
-		while self.transfer_in_progress and self.last_sent + 1 <= len(self.content) and new_ack + self.cwnd > self.last_sent:
-			self.send_line(self.last_sent + 1)
+	def arm_loss_timer(self):
+		if self.loss_timer is not None:
+			self.loss_timer.cancel()
+			self.loss_timer = None
+		if not self.transfer_in_progress or self.last_sent < self.window.base:  # nothing in flight
+			return
+		if self.loss_deadline is not None:
+			delay = max(0, self.loss_deadline - self.server.clock())
+		elif not self.probe_sent and self.recovery.probe_timeout is not None:
+			delay = self.recovery.probe_timeout
+		else:
+			return
+		self.loss_timer = self.server.scheduler.call_later(delay, self.on_loss_timer)
 
-	def send_line(self, index, timer_triggered=False):
-		with global_lock:  # to prevent concurrent send_line
-			if timer_triggered:
-				# assume a lost packet, no congestion
-				if index <= self.last_ack:  # out of date timer, ignore
-					print("Ignoring out of date timer")
-					return
+	def on_loss_timer(self):
+		self.loss_timer = None
+		if not self.transfer_in_progress:
+			return
+		if self.loss_deadline is not None:
+			self.detect_losses()
+		else:
+			self.send_probe()
 
-				if time.time() - self.timer_updated[index] < self.timeout_s:  # timer already updated
-					print("Timer out of date, ignoring")
-					return
+	def send_probe(self):
+		# tail loss probe: the whole flight went unacknowledged, resend the newest packet so
+		# that the ACK it triggers shows what the client is missing
+		logger.debug("Tail loss probe")
+		self.probe_sent = True
+		self.loss_cause = "probe"
+		with self.server.lock:
+			self.transmit_line(self.last_sent)
+		self.arm_loss_timer()
 
-				if self.last_ack + 1 == index:
-					self.duplicated_acks = 0
-				# lower last ack so it doesn't trigger fast retransmit
+	def trace_window(self):
+		window = (self.cc.cwnd, self.cc.ssthresh)
+		if window != self.traced_window:
+			self.traced_window = window
+			self.trace("cwnd", client=self.client_address, cwnd=window[0], ssthresh=window[1])
 
-				self.last_sent = index
-				self.acks_received = 0
-				self.acks_on_max_window = 0
-			# end timer triggered
+	def window_open(self):
+		# selectively acknowledged packets have left the network and no longer count against the window
+		return self.transfer_in_progress and self.last_sent + 1 <= len(self.content) and \
+			self.window_base + self.cc.cwnd + self.window.sacked_count > self.last_sent
 
-			self.last_sent = max(index, self.last_sent)
-			self.time_sent[index] = time.time()
+	def send_window(self, new_ack):
+		self.window_base = new_ack
+		with self.server.lock:
+			if self.server.pacing:
+				self.send_retransmissions()
+				if self.pacing_timer is None:  # otherwise the pacer is already working through the window
+					self.send_paced()
+			else:
+				# the whole burst goes out under a single lock acquisition
+				while self.window_open():
+					self.transmit_line(self.last_sent + 1)
 
-			if index == len(self.content):
-				self.send_fin()
-				return
-			elif index == len(self.content) + 1:
-				self.end_transfer()
+	def send_retransmissions(self):
+		# caller holds the server lock; packets resent after going back are due already, only new data is paced
+		while self.last_sent < self.highest_sent and self.window_open():
+			self.transmit_line(self.last_sent + 1)
+
+	def pacing_interval(self):
+		if self.cc.pacing_rate:
+			return 1 / self.cc.pacing_rate
+		if self.recovery.rtt is None:  # nothing to spread the window over yet
+			return 0
+		gain = PACING_GAIN_SLOW_START if self.cc.cwnd < self.cc.ssthresh else PACING_GAIN_AVOIDANCE
+		return self.recovery.rtt / (gain * self.cc.cwnd)
+
+	def send_paced(self):
+		# caller holds the server lock, sends one packet and schedules the next one
+		self.pacing_timer = None
+		self.send_retransmissions()
+		if self.window_open():
+			self.transmit_line(self.last_sent + 1)
+		if self.window_open():
+			self.pacing_timer = self.server.scheduler.call_later(self.pacing_interval(), self.send_paced)
+
+	def send_line(self, index, timer_triggered=False):
+		with self.server.lock:  # to prevent concurrent send_line
+			self.transmit_line(index, timer_triggered)
+
+	def transmit_line(self, index, timer_triggered=False):
+		# caller holds the server lock
+		if timer_triggered:
+			# assume a lost packet, no congestion
+			if index <= self.last_ack:  # out of date timer, ignore
+				logger.debug("Ignoring out of date timer")
 				return
+			self.trace("timer", client=self.client_address, seq=index)
+			self.loss_cause = "timer"
 
-			self.timer_in_flight += int(timer_triggered)
+			if self.last_ack + 1 == index:
+				self.duplicated_acks = 0
+			# lower last ack so it doesn't trigger fast retransmit
+
+			if index == self.window.base:  # the oldest packet timed out, back off
+				self.recovery.on_timeout()
+			if not self.sack:  # go back and resend everything after the lost packet
+				self.last_sent = index
+			self.cc.on_timeout()
+			self.trace_window()
+		# end timer triggered
 
-			msg = ("{} {}:{}|".format(self.client_address, index, self.content[index]) + get_checksum(
-				self.content[index])).encode()
-			self.sock.sendto(msg, self.sender_address)
-			if index in self.timers:
-				self.timers[index].cancel()
-			self.timers[index] = threading.Timer(self.timeout_s, self.send_line, [index, True])
-			self.timers[index].start()
-			self.timer_updated[index] = time.time()
+		self.last_sent = max(index, self.last_sent)
+		self.window.record_send(index, self.server.clock())
 
-			# increment timout slightly so that we don't get out of order triggers
-			self.timeout_s += TIMEOUT_INCREMENT
+		if index == len(self.content):
+			packet = self.client_id + b" FIN"
+		else:
+			self.timer_in_flight += int(timer_triggered)
+			packet = self.client_id + self.content.packet(index)
+		self.server.sendto(packet, self.sender_address)
+		cause = self.loss_cause if index <= self.highest_sent else None
+		self.metrics.on_send(len(packet), cause)
+		self.trace("send", client=self.client_address, seq=index, size=len(packet), cause=cause)
+		self.highest_sent = max(index, self.highest_sent)
+		if index >= self.window.base:
+			self.window.set_timer(index, self.server.scheduler.call_later(self.recovery.rto, self.send_line, index, True))
+
+	def gauges(self):
+		return {
+			"cwnd": self.cc.cwnd,
+			"ssthresh": self.cc.ssthresh,
+			"srtt_seconds": self.recovery.rtt,
+			"rto_seconds": self.recovery.rto,
+			"last_ack": self.last_ack,
+		}
 
 	def start_transfer(self):
 		self.transfer_in_progress = True
-		for i in range(self.cwnd):
-			self.send_line(i)
-
-	def send_fin(self):
-		fin_msg = "{} FIN".format(self.client_address)
-		self.sock.sendto(fin_msg.encode(), self.sender_address)
+		self.trace("start", client=self.client_address, lines=self.lines, packets=len(self.content))
+		with self.server.lock:
+			for i in range(min(self.cc.cwnd, len(self.content) + 1)):
+				self.transmit_line(i)
 
 	def end_transfer(self):
 		if not self.transfer_in_progress:
 			return
-		print("Ending transfer")
+		logger.debug("Ending transfer")
+		self.trace("end", client=self.client_address)
+		self.transfer_in_progress = False
+		self.server.sendto(self.client_id + b" ACK", self.sender_address)
+
+		self.close()
+		# two RTTs, like a tail loss probe: an RTO from a few samples outlasts the client's retransmissions
+		self.server.remember_closed(self.client_address, self.sender_address,
+		                            self.recovery.probe_timeout or CLOSED_QUIET_TIME)
+		if self.server.path_cache is not None and self.recovery.rtt is not None:
+			self.server.path_cache.update(self.sender_address[0], self.recovery.rtt, self.recovery.deviation,
+			                              self.cc.ssthresh, self.cc.cwnd)
+
+	def check_idle(self):
+		self.idle_timer = None
+		idle = self.server.clock() - self.last_heard
+		if idle < self.server.idle_timeout:
+			self.idle_timer = self.server.scheduler.call_later(self.server.idle_timeout - idle, self.check_idle)
+			return
+		logger.info("No datagram from %s for %.1f seconds, dropping its connection", self.client_address, idle)
+		self.trace("abort", client=self.client_address)
 		self.transfer_in_progress = False
-		self.sock.sendto("{} ACK".format(self.client_address).encode(), self.sender_address)
+		self.close()
 
-		for i in list(self.timers):
-			self.timers[i].cancel()
-			del self.timers[i]
-			if i in self.timer_updated:
-				del self.timer_updated[i]
-		self.reset_variables()
+	def close(self):
+		# stop every timer of the connection and take it out of the table
+		self.window.clear()
+		for timer in (self.pacing_timer, self.loss_timer, self.idle_timer):
+			if timer is not None:
+				timer.cancel()
+		self.pacing_timer = None
+		self.loss_timer = None
+		self.idle_timer = None
+		self.server.remove_connection(self)
+		self.server.metrics.connection_ended(self.metrics)
 
 	def process_ecn(self, data):
 		if not self.transfer_in_progress:
 			return
-		self.ssthresh = max(self.cwnd - 1, 1)
-		self.cwnd = max(1, self.ssthresh - 1)
-		msg = data.decode().split("]")[1].strip()
+		self.metrics.ecn_marks += 1
+		self.loss_cause = "ecn"
+		self.cc.on_ecn()
+		self.trace_window()
+		msg = data.decode("latin-1").split("]")[1].strip()
 		if msg == "FIN":
 			ack_returned = len(self.content)
 		elif msg == "ACK":
-			ack_returned = len(self.content) + 1
+			return  # the transfer is over for the client too
 		else:
 			ack_returned = int(msg.split(":", 1)[0])
+		self.trace("ecn", client=self.client_address, seq=ack_returned)
+
+		if self.sack:  # only the marked packet was dropped
+			if ack_returned > self.last_ack and not self.window.is_sacked(ack_returned):
+				self.send_line(ack_returned)
+			return
 
 		self.last_sent = ack_returned - 1
-		self.acks_on_max_window = 0
-		self.acks_received = 0
 
-		for i in range(max(0, self.cwnd - self.timer_in_flight)):
-			if not self.transfer_in_progress or ack_returned + i > len(self.content) + 1:
+		with self.server.lock:
+			for i in range(max(0, self.cc.cwnd - self.timer_in_flight)):
+				index = ack_returned + i
+				if not self.transfer_in_progress or index > len(self.content) + 1:
+					break
+				if index == len(self.content) + 1:
+					# right after the FIN, close only once the client is known to have every line: now, or
+					# with the ACK of the last line, without waiting another round for the ACK FIN
+					if self.window.base >= len(self.content):
+						self.end_transfer()
+					else:
+						self.close_on_last_ack = True
+					break
+				self.timer_in_flight += 1
+				self.transmit_line(index)
+
+
+class Server:
+	def __init__(self, own_address, engine=default_engine, congestion_control=default_congestion_control,
+	             pacing=False, sock=None, scheduler=None, clock=time.time, metrics_file=None,
+	             metrics_interval=default_metrics_interval, trace_file=None, path_cache_size=0,
+	             path_cache_ttl=default_path_cache_ttl, path_cache_prefix=default_path_cache_prefix,
+	             path_cache_file=None, idle_timeout=default_idle_timeout):
+		self.clock = clock
+		self.idle_timeout = idle_timeout
+		self.tracer = Tracer(trace_file) if trace_file else NULL_TRACER
+		# what earlier connections learned about the paths to their clients, off when the size is 0
+		self.path_cache = PathCache(path_cache_size, path_cache_ttl, path_cache_prefix, clock,
+		                            path_cache_file) if path_cache_size > 0 else None
+		self.metrics = ServerMetrics()
+		self.metrics_file = metrics_file  # rewritten in the Prometheus text format every metrics_interval
+		self.metrics_interval = metrics_interval
+		if engine == "simulation":
+			# driven by simulation.py: datagrams are handed to handle_datagram and
+			# replies go to whatever send_datagram the caller installs
+			self.sock = None
+			self.send_datagram = None
+		else:
+			# a worker of run_workers gets a socket already bound to the shared port
+			self.sock = sock if sock is not None else bind_socket(own_address)
+			self.send_datagram = self.sock.sendto
+		self.outbox = None  # datagrams held back until the current receive batch is processed
+		self.content = None
+		self.connections = {}
+		# client address -> ClosedClient, oldest first: the closing handshake may not have reached the
+		# client, which then keeps asking; answered for as long as an idle connection would be kept
+		self.closed_clients = {}
+		self.engine = engine
+		self.congestion_control = congestion_control
+		self.pacing = pacing
+		if engine == "asyncio":
+			# everything runs on the event loop thread, nothing to lock
+			self.loop = asyncio.new_event_loop()
+			self.lock = contextlib.nullcontext()
+			self.scheduler = EventLoopScheduler(self.loop)
+		elif engine == "simulation":
+			# single-threaded as well, timers run on the simulation's virtual clock
+			self.lock = contextlib.nullcontext()
+			self.scheduler = scheduler
+		else:
+			self.lock = global_lock
+			self.scheduler = TimerScheduler(global_lock)
+
+	def read_content(self, filename):
+		self.content = FileContent(filename)
+
+	def close(self):
+		self.tracer.close()
+		if self.path_cache is not None and self.path_cache.filename is not None:
+			self.path_cache.save()
+
+	def get_connection(self, client_address, sender_address, options=()):
+		connection = self.connections.get(client_address)
+		if connection is not None and connection.options == tuple(options):  # the GET was retransmitted
+			return connection
+		new_connection = Connection(self, client_address, sender_address, options)
+		if connection is not None:  # e.g. a client resuming with another range before its connection timed out
+			logger.info("New GET from %s, replacing its connection", client_address)
+			connection.trace("abort", client=client_address)
+			connection.transfer_in_progress = False
+			connection.close()
+		self.connections[client_address] = new_connection
+		self.closed_clients.pop(client_address, None)
+		return new_connection
+
+	def remove_connection(self, connection):
+		if self.connections.get(connection.client_address) is connection:
+			del self.connections[connection.client_address]
+
+	def remember_closed(self, client_address, sender_address, quiet_time, fin_repeated=False):
+		now = self.clock()
+		self.closed_clients.pop(client_address, None)  # back to the end, the entries stay oldest first
+		self.closed_clients[client_address] = ClosedClient(now, sender_address, quiet_time, fin_repeated)
+		while self.closed_clients:
+			oldest = next(iter(self.closed_clients))
+			if now - self.closed_clients[oldest].answered_at < self.idle_timeout:
 				break
-			self.timer_in_flight += 1
-			self.send_line(ack_returned + i)
+			del self.closed_clients[oldest]
 
-	def run(self):
-		# NOTE: do NOT remove the following print
-		print("%s: listening on IP %s and UDP port %d" % (sys.argv[0], own_ip, own_port))
-		sys.stdout.flush()
+	def answer_closed(self, client_address, req):
+		# like TCP's TIME-WAIT: repeat the end of the closing handshake to a client that missed it, the
+		# FIN to the ACK of a line, the final ACK to the ACK FIN. Within two RTTs of the last answer the
+		# datagram is rather one that crossed it, e.g. the ACK FIN of a FIN sent twice, and a client
+		# that still waits retransmits it anyway
+		closed = self.closed_clients.get(client_address)
+		if closed is None or req[:3] != "ACK":
+			return
+		since = self.clock() - closed.answered_at
+		if since >= self.idle_timeout:
+			return
+		if req == "ACK FIN":
+			if since < closed.quiet_time and not closed.fin_repeated:
+				return
+			reply = b" ACK"
+		elif since < closed.quiet_time:
+			return
+		else:
+			reply = b" FIN"
+		logger.debug("Repeating%s to %s, its transfer is over", reply.decode(), client_address)
+		self.sendto(client_address.encode() + reply, closed.sender_address)
+		self.remember_closed(client_address, closed.sender_address, closed.quiet_time, fin_repeated=reply == b" FIN")
+
+	def sendto(self, data, address):
+		if self.outbox is not None:
+			self.outbox.append((data, address))
+		else:
+			self.send_datagram(data, address)
+
+	def flush_outbox(self):
+		outbox, self.outbox = self.outbox, None
+		send_datagram = self.send_datagram
+		for (data, address) in outbox:
+			send_datagram(data, address)
 
+	def receive_batch(self):
+		# block for the first datagram, then drain whatever else is already queued
+		batch = [self.sock.recvfrom(512)]
+		while RECEIVE_NONBLOCKING and len(batch) < MAX_RECEIVE_BATCH:
+			try:
+				batch.append(self.sock.recvfrom(512, RECEIVE_NONBLOCKING))
+			except BlockingIOError:
+				break
+		return batch
+
+	def run(self, announce=True):
+		# the workers of run_workers leave it to the parent, which announces the port once for all of them
+		if announce:
+			announce_address(self.sock.getsockname())
+
+		if self.metrics_file:
+			self.scheduler.call_later(self.metrics_interval, self.dump_metrics)
+		if self.engine == "asyncio":
+			self.run_event_loop()
+		else:
+			self.run_threaded()
+
+	def dump_metrics(self):
+		# runs as a timer, so the connections do not change while it reads them
+		self.metrics.dump(self.metrics_file, self.connections)
+		self.scheduler.call_later(self.metrics_interval, self.dump_metrics)
+
+	def run_threaded(self):
 		while True:
+			# wait without the lock, so that timers also fire while no datagrams arrive
+			batch = self.receive_batch()
 			with global_lock:
-				(data, self.sender_address) = self.sock.recvfrom(512)
-				self.client_address = get_client_address(data)
-				req = data.decode().split("]")[1].strip()
-
-				if req == "ACK FIN":
-					if self.last_ack != -1:  # prevent processing ack fin twice
-						self.end_transfer()
-				elif data.decode()[:3] == "ECN":
-					self.process_ecn(data)
-				elif req[:3] == "ACK":
-					ack = int(req.split(" ")[1])
-					self.process_ack(ack)
-				elif req == "GET":
-					self.start_transfer()
+				self.outbox = []
+				for (data, sender_address) in batch:
+					self.handle_datagram(data, sender_address)
+				self.flush_outbox()
 			time.sleep(MAIN_THREAD_SLEEP_TIME)  # prevent timer starvation
 
+	def run_event_loop(self):
+		self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: ServerProtocol(self), sock=self.sock))
+		self.loop.run_forever()
+
+	def handle_datagram(self, data, sender_address):
+		client_address = get_client_address(data)
+		req = data.decode("latin-1").split("]")[1].strip()
+		connection = self.connections.get(client_address)
+
+		if req.split(" ")[0] == "GET":
+			# GET may carry options, e.g. "GET 100-199 segments"; clients that send a bare GET get every line,
+			# one per packet
+			options = req.split(" ")[1:]
+			try:
+				connection = self.get_connection(client_address, sender_address, options)
+			except ValueError:
+				logger.warning("Ignoring GET with a malformed line range: %s", req)
+				return
+			connection.start_transfer()
+		elif data[:3] == b"ECN":  # bounced by the network, says nothing about the client being there
+			if connection is not None:
+				connection.process_ecn(data)
+		elif connection is None:  # transfer already ended, or never started
+			self.answer_closed(client_address, req)
+		elif req == "ACK FIN":
+			connection.last_heard = self.clock()
+			connection.process_fin_ack()
+		elif req[:3] == "ACK":
+			connection.last_heard = self.clock()
+			started = time.perf_counter()
+			try:
+				ack = int(req.split(" ")[1])
+			except (IndexError, ValueError):
+				logger.warning("Ignoring malformed ACK: %s", req)
+				return
+			connection.process_ack(ack, get_sack_ranges(req))
+			connection.metrics.ack_processing.observe(time.perf_counter() - started)
+
+
+def bind_socket(own_address, reuse_port=False):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	if reuse_port:  # several worker processes share the port, the kernel spreads clients across them
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind(own_address)
+	return sock
+
+
+def announce_address(address):
+	# NOTE: do NOT remove the following print
+	# the bound address, which tells run_tests.py the port when started with -p 0
+	print("%s: listening on IP %s and UDP port %d" % ((sys.argv[0],) + address))
+	sys.stdout.flush()
+
+
+def run_workers(num_workers, own_address, *server_args, log_level=default_log_level, **server_kwargs):
+	# build the line index once, instead of every worker racing to write it
+	FileContent(CONTENT_FILENAME)
+
+	# one socket per worker in the SO_REUSEPORT group of the port, all bound here: with port 0 the
+	# first one picks the port and the others join it, and the port is announced once
+	sockets = [bind_socket(own_address, reuse_port=True)]
+	own_address = sockets[0].getsockname()
+	sockets += [bind_socket(own_address, reuse_port=True) for _ in range(num_workers - 1)]
+	announce_address(own_address)
+
+	pids = []
+	for worker, sock in enumerate(sockets):
+		pid = os.fork()
+		if pid == 0:
+			for other in sockets:  # each worker keeps only its own socket
+				if other is not sock:
+					other.close()
+			setup_logging(log_level)  # the listener thread does not survive the fork, start one per worker
+			for name in ("metrics_file", "trace_file", "path_cache_file"):  # one file per worker
+				if server_kwargs.get(name):
+					server_kwargs[name] = "{}.{}".format(server_kwargs[name], worker)
+			server = Server(own_address, *server_args, sock=sock, **server_kwargs)
+			server.read_content(CONTENT_FILENAME)
+			try:
+				server.run(announce=False)
+			finally:
+				server.close()
+				os._exit(0)
+		pids.append(pid)
+	for sock in sockets:  # only the workers read from them
+		sock.close()
+
+	# stop the workers too when the parent is terminated
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		for pid in pids:
+			os.waitpid(pid, 0)
+	finally:
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+
+def check_workers(option, opt_str, value, parser):
+	if value < 1:
+		raise OptionValueError("need at least 1 worker")
+	if value > 1 and not hasattr(socket, "SO_REUSEPORT"):
+		raise OptionValueError("multiple workers need SO_REUSEPORT, which this platform does not support")
+	parser.values.workers = value
+
 
 ########
 # Main #
@@ -296,12 +1314,70 @@ if __name__ == "__main__":
 	parser.add_option("-a", "--address", dest="ip", type="string", action="callback",
 	                  callback=check_address, metavar="IPNO", default=default_ip,
 	                  help="IP port to listen on (default: {})".format(default_ip))
+	parser.add_option("--engine", dest="engine", type="choice", choices=["threads", "asyncio"],
+	                  default=default_engine,
+	                  help="threads: blocking receive loop with a timer thread, "
+	                       "asyncio: single-threaded event loop (default: {})".format(default_engine))
+	parser.add_option("--congestion-control", dest="congestion_control", type="choice",
+	                  choices=list(CONGESTION_CONTROLLERS), default=default_congestion_control,
+	                  help="congestion control algorithm: {} (default: {})".format(
+		                  ", ".join(CONGESTION_CONTROLLERS), default_congestion_control))
+	parser.add_option("--pacing", dest="pacing", action="store_true", default=False,
+	                  help="spread each congestion window over the smoothed RTT instead of sending it in one burst")
+	parser.add_option("--workers", dest="workers", type="int", action="callback", callback=check_workers,
+	                  metavar="N", default=default_workers,
+	                  help="number of server processes sharing the port with SO_REUSEPORT (default: {})".format(
+		                  default_workers))
+	parser.add_option("--log-level", dest="log_level", type="choice", choices=["debug", "info", "warning", "error"],
+	                  default=default_log_level,
+	                  help="debug also logs every retransmission decision (default: {})".format(default_log_level))
+	parser.add_option("--metrics-file", dest="metrics_file", type="string", default=None, metavar="FILE",
+	                  help="keep the connection metrics in FILE, in the Prometheus text format "
+	                       "(with --workers, one FILE.<worker> per worker)")
+	parser.add_option("--metrics-interval", dest="metrics_interval", type="float", default=default_metrics_interval,
+	                  metavar="SECONDS",
+	                  help="how often the metrics file is rewritten (default: {})".format(default_metrics_interval))
+	parser.add_option("--idle-timeout", dest="idle_timeout", type="float", default=default_idle_timeout,
+	                  metavar="SECONDS",
+	                  help="drop the connection of a client that sent nothing for this long, e.g. one that went "
+	                       "away mid-transfer (default: {})".format(default_idle_timeout))
+	parser.add_option("--trace", dest="trace_file", type="string", default=None, metavar="FILE",
+	                  help="write every send, ACK, ECN mark, timer and window change to FILE as JSON lines "
+	                       "(with --workers, one FILE.<worker> per worker)")
+	parser.add_option("--path-cache-size", dest="path_cache_size", type="int", default=0, metavar="N",
+	                  help="remember the RTT, ssthresh and window of the last N client paths and start new "
+	                       "transfers to them from there (default: 0, off)")
+	parser.add_option("--path-cache-ttl", dest="path_cache_ttl", type="float", default=default_path_cache_ttl,
+	                  metavar="SECONDS",
+	                  help="how long a path is remembered (default: {})".format(default_path_cache_ttl))
+	parser.add_option("--path-cache-prefix", dest="path_cache_prefix", type="int", default=default_path_cache_prefix,
+	                  metavar="BITS",
+	                  help="clients whose addresses share this prefix share a path, e.g. 24 for a /24 subnet "
+	                       "(default: {})".format(default_path_cache_prefix))
+	parser.add_option("--path-cache-file", dest="path_cache_file", type="string", default=None, metavar="FILE",
+	                  help="load the path cache from FILE at start and save it there on exit "
+	                       "(with --workers, one FILE.<worker> per worker)")
 	(options, args) = parser.parse_args()
 	own_ip = options.ip
 	own_port = options.port
+	server_options = {"metrics_file": options.metrics_file, "metrics_interval": options.metrics_interval,
+	                  "trace_file": options.trace_file, "path_cache_size": options.path_cache_size,
+	                  "path_cache_ttl": options.path_cache_ttl, "path_cache_prefix": options.path_cache_prefix,
+	                  "path_cache_file": options.path_cache_file, "idle_timeout": options.idle_timeout}
+	# exit normally on SIGTERM, so that the trace and the path cache are written out
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-	server = Server((own_ip, own_port))
+	if options.workers > 1:
+		run_workers(options.workers, (own_ip, own_port), options.engine, options.congestion_control, options.pacing,
+		            log_level=options.log_level, **server_options)
+	else:
+		setup_logging(options.log_level)
+		server = Server((own_ip, own_port), options.engine, options.congestion_control, options.pacing,
+		                **server_options)
 
-	server.read_content("server_file.txt")
+		server.read_content(CONTENT_FILENAME)
 
-	server.run()
+		try:
+			server.run()
+		finally:
+			server.close()
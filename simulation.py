@@ -0,0 +1,191 @@
+import io, math, socket, heapq, itertools, collections, contextlib, difflib, random
+import client
+from server import Server, FileContent, TimerHandle, CONTENT_FILENAME, default_congestion_control, get_line_range
+
+CLIENT_ADDRESS = ("127.0.0.1", 40023)
+SERVER_ADDRESS = ("127.0.0.1", 50023)
+CLIENT_RTX_TIMEOUT = 2
+MAX_CLIENT_RTX = 5
+
+# ranges the randomized scenarios are drawn from
+RANDOM_QUEUE_DELAYS = [0.01, 0.1, 0.5, 1]
+RANDOM_MAX_BUFFER_SIZE = 10
+RANDOM_MAX_DROPS = 5
+RANDOM_DROP_RANGE = 60  # packet numbers the drops and duplicate ACKs are picked from
+RANDOM_RANGE_LINES = 30  # --range bounds, past the end of server_file.txt too
+
+
+class VirtualClock:
+	"""Simulated time: it only moves when the simulation runs the next event or
+	waits for a timeout, so nothing ever sleeps. Doubles as the server's timer
+	scheduler."""
+
+	def __init__(self):
+		self.now = 1.0  # like a monotonic clock, never 0, which the send window takes for "not sent"
+		self.heap = []
+		self.counter = itertools.count()  # keeps timers with equal deadlines in arming order
+
+	def __call__(self):
+		return self.now
+
+	def call_later(self, delay, callback, *args):
+		handle = TimerHandle(self.now + delay, callback, args)
+		heapq.heappush(self.heap, (handle.deadline, next(self.counter), handle))
+		return handle
+
+	def run_until(self, deadline, done):
+		"""Run the timers due by `deadline` until `done()`, then move the clock to the deadline if still not done."""
+		while not done():
+			if not self.heap or self.heap[0][0] > deadline:
+				self.now = max(self.now, deadline)
+				return
+			handle = heapq.heappop(self.heap)[2]
+			self.now = max(self.now, handle.deadline)
+			if not handle.cancelled:
+				handle.callback(*handle.args)
+
+
+class SimulatedSocket:
+	"""The client's UDP socket, with the server on the other end of an in-memory wire.
+
+	Datagrams to the server are handled right away, datagrams the server sends
+	back and the ones the client sends to itself queue up in `inbox`.
+	"""
+
+	def __init__(self, clock, server, own_address=CLIENT_ADDRESS, server_address=SERVER_ADDRESS):
+		self.clock = clock
+		self.server = server
+		self.own_address = own_address
+		self.server_address = server_address
+		self.inbox = collections.deque()
+		self.timeout = None
+		server.send_datagram = self.deliver
+
+	def deliver(self, data, address):
+		self.inbox.append((data, self.server_address))
+
+	def settimeout(self, timeout):
+		self.timeout = timeout
+
+	def setblocking(self, flag):
+		self.timeout = None if flag else 0
+
+	def sendto(self, data, address):
+		if address == self.server_address:
+			self.server.handle_datagram(data, self.own_address)
+		else:
+			self.inbox.append((data, self.own_address))
+
+	def recvfrom(self, size):
+		deadline = math.inf if self.timeout is None else self.clock.now + self.timeout
+		self.clock.run_until(deadline, lambda: self.inbox)
+		if self.inbox:
+			return self.inbox.popleft()
+		if deadline == math.inf:  # a real socket would block forever
+			raise RuntimeError("simulation deadlock: blocking receive with no packet or timer pending")
+		raise socket.timeout()
+
+
+def count_different_lines(received, expected):
+	"""Number of lines `diff -y --suppress-common-lines` prints for the two files."""
+	if received == expected:
+		return 0
+	matcher = difflib.SequenceMatcher(None, received.splitlines(), expected.splitlines(), autojunk=False)
+	return sum(max(i2 - i1, j2 - j1) for (tag, i1, i2, j1, j2) in matcher.get_opcodes() if tag != "equal")
+
+
+def expected_output(content, line_range):
+	"""What a client asking for `line_range` ("START[-END]", None for every line) should end up with."""
+	(start, end) = get_line_range([line_range] if line_range else [], len(content))
+	if start == end:
+		return b""
+	return content.data[content.line_bounds(start)[0]:content.line_bounds(end - 1)[1]]
+
+
+_content = None
+
+
+def shared_content():
+	# every simulated server serves the same file, index it once
+	global _content
+	if _content is None:
+		_content = FileContent(CONTENT_FILENAME)
+	return _content
+
+
+def simulated_server(clock, congestion_control=default_congestion_control, pacing=False):
+	"""A server on the virtual `clock`, serving the shared content; datagrams go to its handle_datagram."""
+	server = Server(SERVER_ADDRESS, "simulation", congestion_control, pacing, scheduler=clock, clock=clock)
+	server.content = shared_content()
+	return server
+
+
+def simulate(client_args, congestion_control=default_congestion_control, pacing=False):
+	"""Run one transfer in-process, `client_args` being the client.py options.
+
+	Returns the metrics client.py prints, measured in virtual time.
+	"""
+	options = client.setup_option_parser().parse_args(list(client_args))[0]
+	clock = VirtualClock()
+	server = simulated_server(clock, congestion_control, pacing)
+	sock = SimulatedSocket(clock, server)
+	outfile = io.BytesIO()
+
+	# the server and client logs are not needed to compute the metrics
+	with contextlib.redirect_stdout(io.StringIO()):
+		transfer_client = client.Client(CLIENT_ADDRESS[0], CLIENT_ADDRESS[1], outfile, options.multi_line_segments,
+		                                options.sack, "never", False, line_range=options.line_range,
+		                                integrity=options.integrity, compress=options.compress)
+		acks2triple = list(options.threeacks.split(","))
+		network_processing = client.setup_packet_processor(options)
+		(client_buffer, server_buffer, server_buffer_changes, queuing_delay) = client.setup_buffers(options)
+		emulator = client.RoundsEmulator(sock, SERVER_ADDRESS, network_processing, acks2triple, client_buffer,
+		                                 server_buffer, server_buffer_changes, queuing_delay, clock, False)
+		finished = emulator.run(transfer_client, CLIENT_RTX_TIMEOUT, MAX_CLIENT_RTX)
+		if not finished:
+			transfer_client.set_failed_transfer()
+		finish_time = clock.now
+		additional_packets = client.count_additional_server_packets(sock, SERVER_ADDRESS, clock=clock)
+
+	return {
+		"finished": finished,
+		"different_lines": count_different_lines(outfile.getvalue(), expected_output(server.content, options.line_range)),
+		"ecn_packets": emulator.ecn_packets,
+		"server_packets": emulator.server_packets,
+		"rounds": emulator.rounds(),
+		"additional_packets": additional_packets,
+		"time": finish_time,
+	}
+
+
+def random_scenario(rng):
+	"""Client options for a random mix of queuing delay, buffer size and losses, and of the transfer options."""
+	args = ["--set-queue-delay={}".format(rng.choice(RANDOM_QUEUE_DELAYS))]
+	if rng.random() < 0.7:
+		buffer_size = rng.randint(1, RANDOM_MAX_BUFFER_SIZE)
+		args.append("--set-server-buffer-size={}".format(buffer_size))
+		if rng.random() < 0.3:
+			change = rng.randint(1 - buffer_size, RANDOM_MAX_BUFFER_SIZE - buffer_size)
+			args.append("--set-server-buffer-size-changes={}@{}".format(change, rng.randint(1, 10)))
+	for option in ("--drop-server-packets", "--drop-client-packets", "--generate-three-dup-acks"):
+		if rng.random() < 0.4:
+			packets = rng.sample(range(1, RANDOM_DROP_RANGE), rng.randint(1, RANDOM_MAX_DROPS))
+			args.append("{}={}".format(option, ",".join(str(packet) for packet in sorted(packets))))
+	for option in ("--multi-line-segments", "--sack", "--compress"):
+		if rng.random() < 0.3:
+			args.append(option)
+	if rng.random() < 0.3:
+		args.append("--integrity={}".format(rng.choice(sorted(client.INTEGRITY_CHECKS))))
+	if rng.random() < 0.3:
+		start = rng.randrange(RANDOM_RANGE_LINES)
+		end = rng.randrange(start, RANDOM_RANGE_LINES)
+		args.append("--range={}".format(start if rng.random() < 0.5 else "{}-{}".format(start, end)))
+	return args
+
+
+def random_scenarios(count, seed, **server_args):
+	"""Yield (client options, metrics) for `count` random scenarios, the same ones for the same seed."""
+	rng = random.Random(seed)
+	for _ in range(count):
+		args = random_scenario(rng)
+		yield (args, simulate(args, **server_args))
@@ -0,0 +1,152 @@
+import unittest, io, threading
+import client
+
+
+def lines(first, last):
+	return b"".join(b"line %d\n" % line for line in range(first, last + 1))
+
+
+class ChunkScheduleTest(unittest.TestCase):
+	def setUp(self):
+		self.output = io.BytesIO()
+
+	def claim_in_thread(self, schedule):
+		# claims from another thread, which blocks while the streams are too far ahead; returns the thread and result
+		result = []
+		thread = threading.Thread(target=lambda: result.append(schedule.claim()), daemon=True)
+		thread.start()
+		thread.join(0.1)
+		return thread, result
+
+	def test_short_chunk_is_the_last(self):
+		schedule = client.ChunkSchedule(self.output, 10, max_ahead=4)
+		self.assertEqual([schedule.claim(), schedule.claim()], [0, 1])
+		schedule.deliver(0, lines(0, 9))
+		schedule.deliver(1, lines(10, 13))  # the file has 14 lines
+		self.assertIsNone(schedule.claim())
+		self.assertEqual(self.output.getvalue(), lines(0, 13))
+
+	def test_file_that_is_a_multiple_of_the_chunk(self):
+		# the chunk after the last full one comes back empty, and ends the download
+		schedule = client.ChunkSchedule(self.output, 10, max_ahead=4)
+		self.assertEqual([schedule.claim() for _ in range(3)], [0, 1, 2])
+		schedule.deliver(0, lines(0, 9))
+		schedule.deliver(1, lines(10, 19))
+		self.assertEqual(schedule.claim(), 3)
+		schedule.deliver(2, b"")
+		self.assertIsNone(schedule.claim())
+		schedule.deliver(3, b"")  # claimed before the end was known
+		self.assertEqual(self.output.getvalue(), lines(0, 19))
+		self.assertFalse(schedule.failed)
+
+	def test_range_ending_inside_a_chunk(self):
+		schedule = client.ChunkSchedule(self.output, 10, first_line=5, last_line=17, max_ahead=4)
+		self.assertEqual([schedule.bounds(chunk) for chunk in (schedule.claim(), schedule.claim())], [(5, 14), (15, 17)])
+		self.assertIsNone(schedule.claim())
+		schedule.deliver(1, lines(15, 17))  # a full chunk for its bounds, not the end of the file
+		self.assertIsNone(schedule.last_chunk)
+		schedule.deliver(0, lines(5, 14))
+		self.assertEqual(self.output.getvalue(), lines(5, 17))
+
+	def test_chunks_are_written_in_order(self):
+		schedule = client.ChunkSchedule(self.output, 2, max_ahead=3)
+		for chunk in range(3):
+			schedule.claim()
+		schedule.deliver(2, lines(4, 5))
+		schedule.deliver(1, lines(2, 3))
+		self.assertEqual(self.output.getvalue(), b"")
+		schedule.deliver(0, lines(0, 1))
+		self.assertEqual(self.output.getvalue(), lines(0, 5))
+
+	def test_claims_wait_for_the_output_file(self):
+		schedule = client.ChunkSchedule(self.output, 2, max_ahead=2)
+		self.assertEqual([schedule.claim(), schedule.claim()], [0, 1])
+		thread, result = self.claim_in_thread(schedule)
+		self.assertTrue(thread.is_alive())
+		schedule.deliver(1, lines(2, 3))  # still waiting for chunk 0 to be written
+		thread.join(0.1)
+		self.assertTrue(thread.is_alive())
+		schedule.deliver(0, lines(0, 1))
+		thread.join(5)
+		self.assertEqual(result, [2])
+
+	def test_fail_wakes_up_waiting_claims(self):
+		schedule = client.ChunkSchedule(self.output, 2, max_ahead=1)
+		schedule.claim()
+		thread, result = self.claim_in_thread(schedule)
+		self.assertTrue(thread.is_alive())
+		schedule.fail()
+		thread.join(5)
+		self.assertEqual(result, [None])
+
+
+class IntegrityTest(unittest.TestCase):
+	def test_only_packets_that_pass_their_check_are_stored(self):
+		output = io.BytesIO()
+		transfer_client = client.Client("127.0.0.1", 40000, output, verbose=False)
+		acks = client.PacketBuffer()
+		for name, check in sorted(client.INTEGRITY_CHECKS.items()):
+			with self.subTest(check=name):
+				seqno = transfer_client.last_acked + 1
+				payload = b"line %d" % seqno
+				transfer_client.process_server_packet(b"[127.0.0.1:40000] %d:%b|%b" % (seqno, payload[::-1], check(payload)),
+				                                      acks)
+				self.assertEqual(transfer_client.last_acked, seqno - 1)
+				transfer_client.process_server_packet(b"[127.0.0.1:40000] %d:%b|%b" % (seqno, payload, check(payload)), acks)
+				self.assertEqual(transfer_client.last_acked, seqno)
+		self.assertEqual(output.getvalue(), lines(0, len(client.INTEGRITY_CHECKS) - 1))
+
+
+class FakeEmulator:
+	"""Answers a chunk's GET from `content` at once, or fails it if its first line is in `failing`."""
+
+	def __init__(self, content, failing=()):
+		self.content = content
+		self.failing = failing
+		self.server_packets = 0
+		self.ecn_packets = 0
+
+	def run(self, chunk_client, rtx_timeout, max_rtx):
+		(start, end) = (int(bound) for bound in chunk_client.line_range.split("-"))
+		if start in self.failing:
+			return False
+		chunk_lines = self.content[start:end + 1]
+		chunk_client.outfile.write(b"".join(chunk_lines))
+		self.server_packets = len(chunk_lines) + 1
+		return True
+
+
+class ParallelDownloadTest(unittest.TestCase):
+	def download(self, file_lines, chunk_lines, line_range=None, failing=()):
+		content = [b"line %d\n" % line for line in range(file_lines)]
+		output = io.BytesIO()
+		transfer_client = client.Client("127.0.0.1", 0, output, verbose=False, line_range=line_range)
+		download = client.ParallelDownload(("127.0.0.1", 9), 3, chunk_lines,
+		                                   lambda sock: FakeEmulator(content, failing), 0.01)
+		finished = download.run(transfer_client, 1, 1)
+		download.count_additional_server_packets(0)
+		return finished, output.getvalue(), download
+
+	def test_chunks_are_put_together(self):
+		(finished, output, download) = self.download(25, 4)
+		self.assertTrue(finished)
+		self.assertEqual(output, lines(0, 24))
+		self.assertGreaterEqual(download.server_packets, 25)
+
+	def test_file_that_is_a_multiple_of_the_chunk(self):
+		(finished, output, _) = self.download(24, 4)
+		self.assertTrue(finished)
+		self.assertEqual(output, lines(0, 23))
+
+	def test_range(self):
+		(finished, output, _) = self.download(25, 4, "3-13")
+		self.assertTrue(finished)
+		self.assertEqual(output, lines(3, 13))
+
+	def test_failed_chunk_stops_the_download(self):
+		(finished, _, _) = self.download(100, 4, failing=(8,))
+		self.assertFalse(finished)
+
+
+if __name__ == "__main__":
+	unittest.main()
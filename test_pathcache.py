@@ -0,0 +1,66 @@
+import unittest, tempfile, os
+from pathcache import PathCache, MAX_SEEDED_CWND
+from congestion import INITIAL_CWND
+
+
+class Clock:
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+class PathCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = Clock()
+
+	def cache(self, capacity=3, **kwargs):
+		return PathCache(capacity, ttl=60, clock=self.clock, **kwargs)
+
+	def test_entry_expires_after_the_ttl(self):
+		cache = self.cache()
+		cache.update("10.0.0.1", 0.1, 0.05, 8, 6)
+		self.clock.now += 60
+		self.assertEqual(cache.get("10.0.0.1").rtt, 0.1)
+		self.clock.now += 1
+		self.assertIsNone(cache.get("10.0.0.1"))
+		self.assertEqual(len(cache.entries), 0)
+
+	def test_least_recently_used_is_evicted(self):
+		cache = self.cache()
+		for host in (1, 2, 3):
+			cache.update("10.0.0.{}".format(host), 0.1, 0.05, 8, 6)
+		cache.get("10.0.0.1")  # now the most recently used
+		cache.update("10.0.0.4", 0.1, 0.05, 8, 6)
+		self.assertIsNone(cache.get("10.0.0.2"))
+		self.assertEqual(list(cache.entries), ["10.0.0.3/32", "10.0.0.1/32", "10.0.0.4/32"])
+
+	def test_seeded_window_is_half_the_last_one_within_bounds(self):
+		cache = self.cache()
+		for (cwnd, seeded) in ((1, INITIAL_CWND), (7, 3), (2 * MAX_SEEDED_CWND, MAX_SEEDED_CWND), (1000, MAX_SEEDED_CWND)):
+			cache.update("10.0.0.1", 0.1, 0.05, 8, cwnd)
+			self.assertEqual(cache.get("10.0.0.1").cwnd, seeded)
+
+	def test_prefix_shares_an_entry(self):
+		cache = self.cache(prefix_length=24)
+		cache.update("10.0.0.1", 0.1, 0.05, 8, 6)
+		self.assertEqual(cache.get("10.0.0.200").rtt, 0.1)
+		self.assertIsNone(cache.get("10.0.1.1"))
+
+	def test_save_and_load(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "paths.json")
+			cache = self.cache(filename=filename)
+			cache.update("10.0.0.1", 0.1, 0.05, 8, 6)
+			self.clock.now += 30
+			cache.update("10.0.0.2", 0.2, 0.1, 16, 12)
+			cache.save()
+			self.assertEqual(self.cache(filename=filename).entries, cache.entries)
+			self.assertEqual(list(self.cache(capacity=1, filename=filename).entries), ["10.0.0.2/32"])
+			self.clock.now += 31  # the first entry is past the TTL when loaded
+			self.assertEqual(list(self.cache(filename=filename).entries), ["10.0.0.2/32"])
+
+
+if __name__ == "__main__":
+	unittest.main()
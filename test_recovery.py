@@ -0,0 +1,53 @@
+import unittest
+from recovery import LossRecovery, INITIAL_RTO, MIN_RTO, MAX_RTO, REORDERING_WINDOW_FRACTION
+
+
+class LossRecoveryTest(unittest.TestCase):
+	def test_first_sample_sets_the_rto(self):
+		recovery = LossRecovery()
+		self.assertEqual(recovery.rto, INITIAL_RTO)
+		self.assertIsNone(recovery.probe_timeout)
+		recovery.on_rtt_sample(0.1)
+		self.assertEqual((recovery.rtt, recovery.deviation), (0.1, 0.05))
+		self.assertAlmostEqual(recovery.rto, 0.1 + 6 * 0.05)
+
+	def test_rto_stays_within_bounds(self):
+		recovery = LossRecovery()
+		recovery.on_rtt_sample(0.001)
+		self.assertEqual(recovery.rto, MIN_RTO)
+		recovery.on_rtt_sample(100)
+		self.assertEqual(recovery.rto, MAX_RTO)
+
+	def test_timeouts_back_off_until_a_new_sample(self):
+		recovery = LossRecovery()
+		recovery.on_rtt_sample(0.1)
+		rto = recovery.rto
+		recovery.on_timeout()
+		recovery.on_timeout()
+		self.assertAlmostEqual(recovery.rto, 4 * rto)
+		for _ in range(20):
+			recovery.on_timeout()
+		self.assertEqual(recovery.rto, MAX_RTO)
+		recovery.on_rtt_sample(0.1)
+		self.assertEqual(recovery.backoffs, 0)
+		self.assertLess(recovery.rto, MAX_RTO)
+
+	def test_probe_timeout_is_two_rtts_within_the_rto(self):
+		recovery = LossRecovery()
+		recovery.on_rtt_sample(1)
+		self.assertEqual(recovery.probe_timeout, 2)
+		recovery = LossRecovery()
+		recovery.seed(1, 0)  # no deviation: the RTO is a single RTT
+		self.assertEqual(recovery.probe_timeout, 1)
+
+	def test_loss_deadline_adds_the_reordering_window_of_the_minimum_rtt(self):
+		recovery = LossRecovery()
+		self.assertEqual(recovery.reordering_window, 0)
+		recovery.on_rtt_sample(0.1)
+		recovery.on_rtt_sample(0.3)
+		self.assertAlmostEqual(recovery.reordering_window, REORDERING_WINDOW_FRACTION * 0.1)
+		self.assertAlmostEqual(recovery.loss_deadline(10), 10 + recovery.rtt + REORDERING_WINDOW_FRACTION * 0.1)
+
+
+if __name__ == "__main__":
+	unittest.main()
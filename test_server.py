@@ -0,0 +1,287 @@
+import unittest, tempfile, os, zlib, threading
+import simulation, server, integrity, recovery
+
+CLIENT_ID = "[{}:{}]".format(*simulation.CLIENT_ADDRESS)
+
+
+def live_timers(clock):
+	return [handle for (_, _, handle) in clock.heap if not handle.cancelled]
+
+
+class SimulatedServerTest(unittest.TestCase):
+	"""Drives a server on a virtual clock by hand, with the datagrams it sends collected in `sent`."""
+
+	def setUp(self):
+		self.clock = simulation.VirtualClock()
+		self.server = simulation.simulated_server(self.clock)
+		self.sent = []
+		self.server.send_datagram = lambda data, address: self.sent.append(data)
+
+	def receive(self, message):
+		self.server.handle_datagram("{} {}".format(CLIENT_ID, message).encode(), simulation.CLIENT_ADDRESS)
+
+	def run_for(self, seconds):
+		self.clock.run_until(self.clock.now + seconds, lambda: False)
+
+
+class IdleConnectionTest(SimulatedServerTest):
+	def test_vanished_client_is_dropped(self):
+		self.receive("GET")
+		self.run_for(self.server.idle_timeout - 1)
+		self.assertIn(CLIENT_ID, self.server.connections)
+		self.run_for(2)
+		self.assertEqual(self.server.connections, {})
+		self.assertEqual(live_timers(self.clock), [])
+		sent = len(self.sent)
+		self.run_for(10 * self.server.idle_timeout)
+		self.assertEqual(len(self.sent), sent)
+
+	def test_client_that_keeps_acknowledging_stays(self):
+		self.receive("GET")
+		for _ in range(5):
+			self.run_for(self.server.idle_timeout / 2)
+			self.receive("ACK -1")
+		self.assertIn(CLIENT_ID, self.server.connections)
+
+
+class FutureAckTest(SimulatedServerTest):
+	def test_ack_beyond_last_sent_is_ignored(self):
+		self.receive("GET")
+		connection = self.server.connections[CLIENT_ID]
+		self.assertEqual(connection.highest_sent, 0)  # the initial window is a single packet
+		self.receive("ACK 15")
+		self.assertEqual(connection.last_ack, -1)
+		self.assertEqual(connection.window.base, 0)
+		self.receive("ACK 0")
+		self.assertEqual(connection.last_ack, 0)
+		self.assertEqual(connection.window.base, 1)
+		self.assertEqual(connection.highest_sent, 2)  # the window grew to 2
+
+
+class LossRecoveryTest(SimulatedServerTest):
+	def sent_sequence_numbers(self, first):
+		return [int(data[len(CLIENT_ID) + 1:].partition(b":")[0]) for data in self.sent[first:]]
+
+	def start(self, options=""):
+		# the first packet is acknowledged after 0.1s, which sends packets 1 and 2
+		self.receive("GET " + options)
+		self.run_for(0.1)
+		self.receive("ACK 0")
+		return self.server.connections[CLIENT_ID]
+
+	def test_rtt_is_sampled_from_packets_sent_once(self):
+		connection = self.start()
+		self.assertAlmostEqual(connection.recovery.rtt, 0.1)
+
+	def test_ack_of_a_retransmitted_packet_gives_no_sample(self):
+		self.receive("GET")
+		connection = self.server.connections[CLIENT_ID]
+		self.run_for(recovery.INITIAL_RTO)
+		self.assertEqual(connection.metrics.retransmits["timer"], 1)
+		self.assertEqual(connection.recovery.backoffs, 1)
+		self.receive("ACK 0")  # Karn: it may answer either copy
+		self.assertIsNone(connection.recovery.rtt)
+		self.assertEqual(connection.recovery.rto, 2 * recovery.INITIAL_RTO)
+		self.run_for(0.1)
+		self.receive("ACK 1")  # sent once, resets the backoff
+		self.assertAlmostEqual(connection.recovery.rtt, 0.1)
+		self.assertEqual(connection.recovery.backoffs, 0)
+
+	def test_packet_is_lost_after_the_reordering_window(self):
+		connection = self.start("sack")
+		self.run_for(0.1)
+		first = len(self.sent)
+		self.receive("ACK 0 SACK 2-2")  # 1 was sent with 2, but may still arrive for a quarter of the minimum RTT
+		self.run_for(0.02)
+		self.assertEqual(connection.metrics.retransmits["rack"], 0)
+		self.run_for(0.01)
+		self.assertEqual(connection.metrics.retransmits["rack"], 1)
+		self.assertEqual(self.sent_sequence_numbers(first), [1])
+
+	def test_tail_loss_probe_resends_the_newest_packet(self):
+		connection = self.start()
+		first = len(self.sent)
+		self.run_for(2 * connection.recovery.rtt - 0.01)
+		self.assertEqual(len(self.sent), first)
+		self.run_for(0.02)  # two RTTs, before the RTO
+		self.assertEqual(connection.metrics.retransmits["probe"], 1)
+		self.assertEqual(connection.metrics.retransmits["timer"], 0)
+		self.assertEqual(self.sent_sequence_numbers(first), [2])
+
+
+class MalformedAckTest(SimulatedServerTest):
+	def test_malformed_sack_blocks_are_dropped(self):
+		self.receive("GET sack")
+		connection = self.server.connections[CLIENT_ID]
+		for message in ("ACK 0 SACK 2", "ACK 0 SACK 2-x", "ACK 0 SACK -,", "ACK x", "ACK"):
+			self.receive(message)
+		self.assertIs(self.server.connections[CLIENT_ID], connection)
+		self.assertEqual(connection.last_ack, 0)
+		self.assertEqual(server.get_sack_ranges("ACK 0 SACK 2,4-5,6-y"), [(4, 5)])
+
+
+class ClosedClientTest(SimulatedServerTest):
+	def test_lost_final_ack_is_sent_again(self):
+		self.receive("GET 20")  # past the last line: nothing but the FIN
+		self.assertEqual(self.sent[-1], CLIENT_ID.encode() + b" FIN")
+		self.receive("ACK FIN")
+		self.assertEqual(self.server.connections, {})
+		self.assertEqual(self.sent[-1], CLIENT_ID.encode() + b" ACK")
+		sent = len(self.sent)
+		self.receive("ACK FIN")  # a duplicate that crossed the final ACK
+		self.assertEqual(len(self.sent), sent)
+		self.run_for(self.server.closed_clients[CLIENT_ID].quiet_time)
+		self.receive("ACK FIN")  # the client retransmits, it did not get the final ACK
+		self.assertEqual(self.sent[sent:], [CLIENT_ID.encode() + b" ACK"])
+
+	def test_closed_client_is_forgotten(self):
+		self.receive("GET 20")
+		self.receive("ACK FIN")
+		sent = len(self.sent)
+		self.run_for(self.server.idle_timeout)
+		self.receive("ACK FIN")
+		self.assertEqual(len(self.sent), sent)
+
+
+class ResumeTest(SimulatedServerTest):
+	def acknowledge_everything(self, first):
+		# plays a client that loses nothing, from the datagram `first` on; returns the lines it got
+		lines = []
+		for data in iter_growing(self.sent, first):
+			message = data[len(CLIENT_ID) + 1:]
+			if message == b"ACK":
+				return b"".join(lines)
+			if message == b"FIN":
+				self.receive("ACK FIN")
+			else:
+				(seq, _, rest) = message.partition(b":")
+				lines.append(rest[:rest.rindex(b"|")])
+				self.receive("ACK {}".format(int(seq)))
+		self.fail("the transfer did not end")
+
+	def test_get_with_other_options_starts_over(self):
+		self.receive("GET")
+		abandoned = self.server.connections[CLIENT_ID]
+		self.receive("ACK 0")  # then the client restarts on the same port and resumes after line 0
+		first = len(self.sent)
+		self.receive("GET 1-3")
+		connection = self.server.connections[CLIENT_ID]
+		self.assertIsNot(connection, abandoned)
+		self.assertTrue(all(handle.callback.__self__ is connection for handle in live_timers(self.clock)))
+		self.assertEqual(self.acknowledge_everything(first),
+		                 simulation.expected_output(self.server.content, "1-3"))
+
+	def test_retransmitted_get_keeps_the_connection(self):
+		self.receive("GET 1-3 sack")
+		connection = self.server.connections[CLIENT_ID]
+		self.receive("GET 1-3 sack")
+		self.assertIs(self.server.connections[CLIENT_ID], connection)
+
+
+class IntegrityTest(SimulatedServerTest):
+	def first_packet(self, options):
+		# payload and checksum of the first packet answering "GET <options>", from a new connection
+		self.receive("GET " + options)
+		(payload, _, checksum) = self.sent[-1][len(CLIENT_ID) + 1:].partition(b":")[2].rpartition(b"|")
+		return payload, checksum
+
+	def test_every_check_round_trips(self):
+		for name in integrity.INTEGRITY_CHECKS:
+			for transfer in ("", "segments", "segments deflate"):
+				with self.subTest(check=name, transfer=transfer):
+					(payload, checksum) = self.first_packet("{} {}".format(transfer, name).strip())
+					self.assertEqual(checksum, integrity.INTEGRITY_CHECKS[name](payload))
+					self.assertTrue(integrity.check_integrity(payload, checksum))
+					corrupted = bytes([payload[0] ^ 1]) + payload[1:]
+					self.assertFalse(integrity.check_integrity(corrupted, checksum))
+
+	def test_unknown_check_falls_back_to_md5(self):
+		(payload, checksum) = self.first_packet("sha1")
+		self.assertEqual(checksum, integrity.md5(payload))
+		self.assertTrue(integrity.check_integrity(payload, checksum))
+
+	def test_checksum_of_unknown_length_is_rejected(self):
+		self.assertFalse(integrity.check_integrity(b"line", integrity.md5(b"line")[:-1]))
+
+
+class MetricsTest(SimulatedServerTest):
+	def test_each_family_is_typed_once_before_its_series(self):
+		self.receive("GET")
+		self.run_for(0.1)
+		self.receive("ACK 0")
+		families = []
+		for line in self.server.metrics.render(self.server.connections).splitlines():
+			if line.startswith("# TYPE "):
+				(_, _, name, metric_type) = line.split(" ")
+				self.assertNotIn(name, [family for (family, _) in families])
+				families.append((name, metric_type))
+			elif not line.startswith("# HELP "):
+				(name, metric_type) = families[-1]
+				suffixes = ("_bucket", "_sum", "_count") if metric_type == "histogram" else ("",)
+				self.assertIn(line.partition("{")[0].partition(" ")[0], [name + suffix for suffix in suffixes])
+		self.assertIn(("rudp_retransmits_total", "counter"), families)
+		self.assertIn(("rudp_rtt_seconds", "histogram"), families)
+		self.assertIn(("rudp_cwnd", "gauge"), families)
+
+
+class SendWindowTest(unittest.TestCase):
+	def test_highest_sacked_follows_marks_and_advances(self):
+		window = server.SendWindow(capacity=4)
+		self.assertIsNone(window.highest_sacked())
+		for index in (5, 2, 9):  # 9 makes the ring grow
+			window.mark_sacked(index)
+		self.assertEqual(window.highest_sacked(), 9)
+		window.advance(4)
+		self.assertEqual(window.highest_sacked(), 9)
+		window.advance(9)
+		self.assertIsNone(window.highest_sacked())
+		window.mark_sacked(12)
+		window.clear()
+		self.assertIsNone(window.highest_sacked())
+
+
+class TimerSchedulerTest(unittest.TestCase):
+	def test_failing_callback_does_not_stop_the_other_timers(self):
+		scheduler = server.TimerScheduler(threading.Lock())
+		fired = threading.Event()
+		with self.assertLogs("server", "ERROR"):
+			scheduler.call_later(0, lambda: 1 / 0)
+			scheduler.call_later(0.01, fired.set)
+			self.assertTrue(fired.wait(5))
+
+
+class CompressedRangeTest(unittest.TestCase):
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		filename = os.path.join(directory.name, "lines.txt")
+		with open(filename, "wb") as f:
+			f.write(b"".join(b"%d %s\n" % (line, b"x" * (line % 97)) for line in range(3000)))
+		self.content = server.FileContent(filename)
+		self.addCleanup(self.content.file.close)
+
+	def test_range_shares_the_segments_of_the_file(self):
+		compressed = self.content.compressed_segments()
+		(first, last) = (compressed.starts[10], compressed.starts[20])
+		segments = server.ContentRange(self.content, first - 3, last + 3).compressed_segments()
+		shared = [block for block in segments.blocks if any(block is other for other in compressed.blocks[10:20])]
+		self.assertEqual(len(shared), 10)
+
+	def test_range_decompresses_to_its_lines(self):
+		for (start, end) in ((0, 3000), (1, 2), (5, 1234), (700, 3000)):
+			segments = server.ContentRange(self.content, start, end).compressed_segments()
+			self.assertTrue(all(len(segments.payload(index)) <= segments.payload_limit for index in range(len(segments))))
+			self.assertEqual(b"".join(zlib.decompress(segments.payload(index)) for index in range(len(segments))),
+			                 b"".join(self.content.payload(line) for line in range(start, end)))
+
+
+def iter_growing(items, start):
+	# like iter(items[start:]), but also yields what is appended while iterating
+	index = start
+	while index < len(items):
+		yield items[index]
+		index += 1
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,182 @@
+import sys, csv, bisect, collections
+from optparse import OptionParser
+from tracing import read_trace
+from run_tests import OKBLUE, OKGREEN, FAIL, HEADER, ENDC
+
+
+def first(events, name):
+	return next((event for event in events if event["event"] == name), None)
+
+
+def connection_events(server_events, client_id=None):
+	"""The events of one connection of a server trace, the first one there is if `client_id` is None."""
+	if client_id is None:
+		start = first(server_events, "start")
+		if start is None:
+			return []
+		client_id = start["client"]
+	client_id = "[{}]".format(client_id.strip("[]"))
+	return [event for event in server_events if event.get("client") == client_id]
+
+
+def transfer_metrics(client_events, server_events=None):
+	"""The metrics run_tests.py checks, rebuilt from the traces.
+
+	The number of different lines needs the server trace, for the number of lines
+	of the file; it is None without it.
+	"""
+	server_packets = [event for event in client_events if event["event"] == "server_packet"]
+	start = first(client_events, "start")
+	finish = first(client_events, "finish")
+	if start is None or finish is None:
+		raise ValueError("the client trace does not cover a whole transfer")
+	different_lines = None
+	server_start = first(server_events or [], "start")
+	if server_start is not None:
+		# the client writes the lines it got in order, what is missing differs from the server file
+		delivered = sum(event["lines"] for event in client_events if event["event"] == "deliver")
+		different_lines = abs(server_start["lines"] - delivered) if finish["finished"] else server_start["lines"]
+	return collections.OrderedDict([
+		("different lines in client file", different_lines),
+		("server-triggered ECN packets", sum(event["fate"] == "ecn" for event in server_packets)),
+		("total server packets", sum(event["fate"] != "dropped" for event in server_packets)),
+		("RTTs to complete flow", finish["rounds"]),
+		("server packets after the file transfer completed", sum(event["event"] == "additional" for event in client_events)),
+		("Total time to complete transfer", finish["t"] - start["t"]),
+	])
+
+
+def retransmission_causes(server_events):
+	"""Retransmitted packets by what triggered them, and how often the retransmission timer fired."""
+	causes = collections.Counter(event["cause"] for event in server_events
+	                             if event["event"] == "send" and event["cause"] is not None)
+	return causes, sum(event["event"] == "timer" for event in server_events)
+
+
+def round_starts(client_events):
+	"""When each round of the client's emulator started."""
+	start = first(client_events, "start")
+	if start["emulator"] == "rounds":
+		return [event["t"] for event in client_events if event["event"] == "round"]
+	rounds = first(client_events, "finish")["rounds"]
+	return [start["t"] + i * start["round_time"] for i in range(rounds)]
+
+
+def per_round_windows(server_events, starts):
+	"""(round, packets sent, retransmissions, cwnd at the start of the round) for every round."""
+	rows = [[i + 1, 0, 0, None] for i in range(len(starts))]
+	cwnd = None
+	cwnd_changes = iter(event for event in server_events if event["event"] == "cwnd")
+	change = next(cwnd_changes, None)
+	for row, start in zip(rows, starts):
+		while change is not None and change["t"] <= start:
+			cwnd = change["cwnd"]
+			change = next(cwnd_changes, None)
+		row[3] = cwnd
+	for event in server_events:
+		if event["event"] != "send":
+			continue
+		i = bisect.bisect_right(starts, event["t"]) - 1
+		if 0 <= i < len(rows):
+			rows[i][1] += 1
+			if event["cause"] is not None:
+				rows[i][2] += 1
+	return [tuple(row) for row in rows]
+
+
+def write_sequence_csv(filename, server_events, client_events):
+	"""Sequence/time data: what the server sent, the ACKs it got and what the client delivered."""
+	origin = min(event["t"] for event in server_events + client_events)
+	rows = []
+	for event in server_events:
+		if event["event"] == "send":
+			rows.append((event["t"], "send", event["seq"], event["cause"] or ""))
+		elif event["event"] in ("ack", "dupack"):
+			rows.append((event["t"], event["event"], event["ack"], ""))
+	for event in client_events:
+		if event["event"] == "deliver":
+			rows.append((event["t"], "deliver", event["seq"], ""))
+	rows.sort()
+	with open(filename, "w", newline="") as f:
+		writer = csv.writer(f)
+		writer.writerow(("time", "event", "seq", "cause"))
+		for (t, name, seq, cause) in rows:
+			writer.writerow(("{:.6f}".format(t - origin), name, seq, cause))
+
+
+def plot_sequence(filename, server_events, client_events):
+	"""Sequence number over time, as an image; returns False if matplotlib is not installed."""
+	try:
+		import matplotlib
+		matplotlib.use("Agg")
+		import matplotlib.pyplot as plt
+	except ImportError:
+		return False
+	origin = min(event["t"] for event in server_events + client_events)
+	sends = [event for event in server_events if event["event"] == "send"]
+	series = [
+		("sent", [event for event in sends if event["cause"] is None], "."),
+		("retransmitted", [event for event in sends if event["cause"] is not None], "x"),
+		("acknowledged", [event for event in server_events if event["event"] == "ack"], "_"),
+		("delivered", [event for event in client_events if event["event"] == "deliver"], "+"),
+	]
+	(figure, axes) = plt.subplots()
+	for (label, events, marker) in series:
+		key = "ack" if label == "acknowledged" else "seq"
+		axes.plot([event["t"] - origin for event in events], [event[key] for event in events], marker,
+		          linestyle="none", label=label)
+	axes.set_xlabel("time (s)")
+	axes.set_ylabel("sequence number")
+	axes.legend()
+	figure.savefig(filename)
+	return True
+
+
+if __name__ == "__main__":
+	parser = OptionParser(usage="%prog [--server TRACE] [--client TRACE] [options]")
+	parser.add_option("--server", dest="server_trace", type="string",
+	                  help="trace written by server.py --trace")
+	parser.add_option("--client", dest="client_trace", type="string",
+	                  help="trace written by client.py --trace")
+	parser.add_option("--client-id", dest="client_id", type="string",
+	                  help="IP:PORT of the connection to look at in the server trace (default: the first one)")
+	parser.add_option("--csv", dest="csv_file", type="string",
+	                  help="write the sequence/time data of the transfer there")
+	parser.add_option("--plot", dest="plot_file", type="string",
+	                  help="draw the sequence/time plot there, needs matplotlib")
+	(options, args) = parser.parse_args()
+	if options.server_trace is None and options.client_trace is None:
+		parser.error("give at least one of --server and --client")
+
+	server_events = connection_events(read_trace(options.server_trace), options.client_id) if options.server_trace else []
+	client_events = read_trace(options.client_trace) if options.client_trace else []
+
+	if client_events:
+		print(f"{HEADER}Transfer metrics{ENDC}")
+		for (name, value) in transfer_metrics(client_events, server_events or None).items():
+			print("# {} --> {}".format(name, "n/a" if value is None else value))
+
+	if server_events:
+		print(f"{HEADER}Retransmissions{ENDC}")
+		(causes, timer_fires) = retransmission_causes(server_events)
+		for (cause, count) in sorted(causes.items()):
+			print(f"# {cause} --> {FAIL}{count}{ENDC}")
+		if not causes:
+			print(f"# {OKGREEN}none{ENDC}")
+		print(f"# retransmission timer fired --> {timer_fires}")
+
+	if server_events and client_events:
+		print(f"{HEADER}Per-RTT window{ENDC}")
+		print("# round  sent  retransmitted  cwnd")
+		for (round_no, sent, retransmitted, cwnd) in per_round_windows(server_events, round_starts(client_events)):
+			print("# {:5}  {:4}  {:13}  {}".format(round_no, sent, retransmitted, "-" if cwnd is None else cwnd))
+
+	if options.csv_file:
+		write_sequence_csv(options.csv_file, server_events, client_events)
+		print(f"# Sequence/time data written to {OKBLUE}{options.csv_file}{ENDC}")
+	if options.plot_file:
+		if plot_sequence(options.plot_file, server_events, client_events):
+			print(f"# Sequence/time plot written to {OKBLUE}{options.plot_file}{ENDC}")
+		else:
+			print(f"{FAIL}matplotlib is not installed, no plot; the --csv data can be plotted elsewhere{ENDC}")
+			sys.exit(1)
@@ -0,0 +1,58 @@
+import json, time
+
+TRACE_BUFFER_SIZE = 1 << 16
+
+
+class Tracer:
+	"""Writes protocol events as JSON lines: {"t": <seconds>, "event": <name>, ...fields}.
+
+	Timestamps come from `clock`, time.monotonic by default, which the server
+	and client processes on the same host share, so their traces line up.
+	"""
+
+	def __init__(self, filename, clock=time.monotonic):
+		self.file = open(filename, "w", buffering=TRACE_BUFFER_SIZE)
+		self.clock = clock
+
+	def event(self, name, **fields):
+		fields["t"] = round(self.clock(), 6)
+		fields["event"] = name
+		self.file.write(json.dumps(fields, separators=(",", ":")) + "\n")
+
+	def packet(self, name, data, **fields):
+		# a packet event, with what identifies the packet
+		fields.update(packet_fields(data))
+		self.event(name, **fields)
+
+	def close(self):
+		self.file.close()
+
+
+class NullTracer:
+	"""Stands in when tracing is off."""
+
+	def event(self, name, **fields):
+		pass
+
+	def packet(self, name, data, **fields):
+		pass  # every packet goes through here, the packet is not even parsed
+
+	def close(self):
+		pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def packet_fields(data):
+	# what a trace records about a packet: its sequence number, or the message of control packets
+	msg = data[data.find(b"] ") + 2:]
+	colon = msg.find(b":")
+	if colon > 0 and msg[:colon].isdigit():
+		return {"seq": int(msg[:colon])}
+	return {"msg": msg.decode(errors="replace")}
+
+
+def read_trace(filename):
+	with open(filename) as f:
+		return [json.loads(line) for line in f if line.strip()]